@@ -0,0 +1,95 @@
+"""Startup benchmark for the entry points (cron runs start a fresh interpreter every time).
+
+Each entry point is imported in a new python process, then the shared flywheel client is
+used for the first time. Reports import time, time to the first API call and the wall time
+of the whole process up to that call (interpreter startup included), median of --repeat
+runs, and which heavy packages were loaded by the import alone.
+
+Without --api-key nothing is sent: the first call is timed up to the point the client is
+ready to send (sdk loaded, client built and pooled). With --api-key the first call is a
+real fw.get_current_user() round trip.
+
+    python -m benchmarks.bench_startup --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+ENTRY_POINTS = {
+    "run_autoworkflow": "run_autoworkflow",
+    "gears": "helper_functions.gears",
+    "tables": "helper_functions.tables",
+    "fileIO": "helper_functions.fileIO",
+    "utils": "helper_functions.utils",
+}
+
+HEAVY_PACKAGES = ["flywheel", "pandas", "numpy", "pyarrow"]
+
+# runs in the child process: import the entry point, then make the first API call
+PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+imported = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+
+from helper_functions import client
+api_key = {api_key!r}
+if api_key:
+    client.configure(api_key=api_key)
+    client.fw.get_current_user()
+else:
+    client.configure(api_key="localhost:443:offline", auth_check=False)
+    client.get_client()
+called = time.perf_counter()
+print(json.dumps({{"import": imported - start, "first_call": called - start, "heavy": heavy}}))
+"""
+
+
+def probe(module, api_key=None):
+    code = PROBE.format(module=module, heavy=HEAVY_PACKAGES, api_key=api_key)
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def run(names, repeat=5, api_key=None):
+    results = []
+    for name in names:
+        runs = [probe(ENTRY_POINTS[name], api_key) for _ in range(repeat)]
+        results.append({
+            "entry point": name,
+            "import": statistics.median(r["import"] for r in runs),
+            "first_call": statistics.median(r["first_call"] for r in runs),
+            "process": statistics.median(r["process"] for r in runs),
+            "heavy": runs[0]["heavy"],
+        })
+    return results
+
+
+def report(results):
+    print(f"{'entry point':<20}{'import s':>10}{'first call s':>14}{'process s':>12}  loaded by import")
+    for r in results:
+        print(f"{r['entry point']:<20}{r['import']:>10.3f}{r['first_call']:>14.3f}{r['process']:>12.3f}  {', '.join(r['heavy']) or '-'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("entry_points", nargs="*", help=f"entry points to measure (default: all of {', '.join(ENTRY_POINTS)})")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per entry point, the median is reported")
+    parser.add_argument("--api-key", default=os.environ.get("FW_API_KEY"), help="time a real first API call against this flywheel instance (default: $FW_API_KEY)")
+    args = parser.parse_args()
+    unknown = set(args.entry_points) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(sorted(unknown))}")
+
+    report(run(args.entry_points or list(ENTRY_POINTS), args.repeat, args.api_key))
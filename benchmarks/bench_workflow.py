@@ -0,0 +1,156 @@
+"""Offline benchmark for the gear-rules workflow and status tables.
+
+Builds a synthetic project in a fake flywheel client with simulated API latency and reports
+wall time and API call counts for run_auto_gear, my_checks, get_table_by_template,
+get_table_by_gearname and the --batch submission (collect, batch.submit_batch, and a re-run
+that must not collect the submitted analyses again).
+
+    python -m benchmarks.bench_workflow --sessions 50 --acquisitions 5 --analyses 3 --latency 0.01
+"""
+import argparse
+import copy
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.fake_flywheel import FakeClient
+
+# same workflow as gears_template_example.json
+TEMPLATE = {
+    "analysis": [
+        {
+            "gear-name": "curate-bids",
+            "gear-version": "2.1.3_1.0.7",
+            "inputs": {"template": {"regex": "-reproin-template.json$", "parent-container": "project", "optional": True}},
+            "config": {"reset": True},
+            "tags": [],
+            "count-failures": 1,
+            "sleep_seconds": 0,
+        },
+        {
+            "gear-name": "hierarchy-curator",
+            "gear-version": "2.1.4_inc0.2",
+            "inputs": {
+                "curator": {"regex": "_completeness.py$", "parent-container": "project"},
+                "additional-input-one": {"regex": "_completeness_template.csv$", "parent-container": "project"},
+            },
+            "config": {"reset": True},
+            "tags": [],
+            "custom-label": "completeness-curator",
+            "count-failures": 1,
+            "prerequisites": [{"prereq-gear": "curate-bids", "prereq-complete-analysis": "any"}],
+            "sleep_seconds": 0,
+        },
+        {
+            "gear-name": "bids-mriqc",
+            "gear-version": "1.2.4_22.0.6_inc1.2",
+            "inputs": {"bidsignore": {"value": ".bidsignore", "parent-container": "project", "optional": True}},
+            "config": {"mem_gb": 16},
+            "tags": ["hpc"],
+            "count-failures": 2,
+            "prerequisites": [
+                {"prereq-gear": "curate-bids", "prereq-complete-analysis": "any"},
+                {"prereq-gear": "hierarchy-curator", "prereq-analysis-label": "completeness-curator", "prereq-complete-analysis": "any"},
+            ],
+            "sleep_seconds": 0,
+            "completeness-tags": ["Run Downstream Analyses"],
+        },
+    ]
+}
+
+HELPER_MODULES = ["gears", "resolver", "analysis_index", "context", "throttle", "batch", "tables"]
+
+
+def install(client):
+    """Points every helper module at the fake client through the shared client provider."""
+    from helper_functions import client as provider
+
+    provider.set_client(client)
+    return {name: __import__("helper_functions." + name, fromlist=[name]) for name in HELPER_MODULES}
+
+
+def measure(client, results, name, fn, *args, **kwargs):
+    client.reset_calls()
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    results.append({"function": name, "seconds": elapsed, "calls": client.total_calls(), "by_call": dict(client.calls)})
+    return out
+
+
+def report(results, verbose=False):
+    print(f"{'function':<28}{'seconds':>10}{'api calls':>12}")
+    for r in results:
+        print(f"{r['function']:<28}{r['seconds']:>10.3f}{r['calls']:>12}")
+        if verbose:
+            for call, n in sorted(r["by_call"].items(), key=lambda x: -x[1]):
+                print(f"    {call:<30}{n:>8}")
+
+
+def run(n_sessions, n_acquisitions, n_analyses, latency, verbose=False):
+    client = FakeClient(latency=latency)
+    project = client.make_project(copy.deepcopy(TEMPLATE), n_sessions, n_acquisitions, n_analyses)
+    modules = install(client)
+    gears, tables = modules["gears"], modules["tables"]
+    session_ids = list(project.session_ids)
+
+    results = []
+
+    def check_all():
+        for sid in session_ids:
+            session = client.containers[sid]
+            for step in TEMPLATE["analysis"]:
+                gears.my_checks(session, step)
+
+    measure(client, results, "my_checks", check_all)
+
+    # one full run of the workflow over every session (jobs are "submitted" to the fake client)
+    measure(client, results, "run_auto_gear", lambda: [gears.run_auto_gear(sid) for sid in session_ids])
+
+    user_inputs = {"project": project.label, "group": project.group}
+    measure(client, results, "get_table_by_template", tables.get_table_by_template, dict(user_inputs))
+    measure(client, results, "get_table_by_gearname", tables.get_table_by_gearname, dict(user_inputs), "curate-bids")
+
+    batch_summary = run_batch(client, modules, results, n_sessions, n_acquisitions)
+
+    report(results, verbose)
+    print("batch: {submitted} submitted, {failed} failed in {batches} batches, {recollected} collected again on the next run".format(**batch_summary))
+    return results
+
+
+def run_batch(client, modules, results, n_sessions, n_acquisitions):
+    # --batch mode on a fresh project without analyses: collect, submit, then collect again as the next run would
+    gears, batch = modules["gears"], modules["batch"]
+    project = client.make_project(copy.deepcopy(TEMPLATE), n_sessions, n_acquisitions, 0, label="bench-batch")
+    collected = []
+    measure(client, results, "run_auto_gear (collect)", lambda: [gears.run_auto_gear(sid, collect=collected) for sid in project.session_ids])
+
+    # utility gear jobs go through premade batch proposals, including two identical jobs on one session
+    utility = client.add_gear("bench-utility", "1.0.0", category="utility")
+    session = client.containers[project.session_ids[0]]
+    collected += [{"session": session, "step": 0, "gear": utility, "config": {}, "inputs": {}, "tags": [], "label": label}
+                  for label in ("bench-utility", "bench-utility", "bench-utility other")]
+    submitted = measure(client, results, "submit_batch", batch.submit_batch, collected, chunk_size=50)
+
+    # submitted analyses must be found by label on the next run, so nothing is collected twice
+    recollected = []
+    for sid in project.session_ids:
+        gears.run_auto_gear(sid, collect=recollected)
+    return {"submitted": len(submitted["submitted"]), "failed": len(submitted["failed"]),
+            "batches": len(submitted["batches"]), "recollected": len(recollected)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20, help="number of sessions (N)")
+    parser.add_argument("--acquisitions", type=int, default=5, help="acquisitions per session (M)")
+    parser.add_argument("--analyses", type=int, default=3, help="existing analyses per session (K)")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated seconds per API call")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show call counts per API method")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    run(args.sessions, args.acquisitions, args.analyses, args.latency, args.verbose)
@@ -0,0 +1,362 @@
+"""In-memory stand-in for the parts of flywheel.Client used by helper_functions.
+
+Every client call sleeps for a configurable latency and is counted, so the number of API
+round trips and the wall time of a workflow can be measured without a flywheel instance.
+"""
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+_ids = itertools.count(1)
+
+
+def new_id():
+    # 24 character hex ids, same shape as flywheel object ids
+    return "{:024x}".format(next(_ids))
+
+
+def _lookup(obj, dotted):
+    # value of a dotted filter key ("parents.project") on a fake object, None if missing
+    for key in dotted.split("."):
+        obj = obj.get(key) if isinstance(obj, dict) else None
+    return obj
+
+
+def _page(items, limit=None, after_id=None):
+    # limit/after_id paging over id ordered results, like flywheel list endpoints
+    items = sorted(items, key=lambda x: x.id)
+    if after_id:
+        items = [x for x in items if x.id > after_id]
+    return items[:limit] if limit else items
+
+
+class FakeObject(dict):
+    """dict with attribute access, like flywheel models (obj.label and obj["label"])."""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+class FakeFile(FakeObject):
+
+    def read(self):
+        self.client._call("read_file")
+        return self["content"]
+
+    def download(self, dest):
+        self.client._call("download_file")
+        with open(dest, "wb") as f:
+            f.write(self["content"])
+
+    def ref(self):
+        return {"type": self.parent.container_type, "id": self.parent.id, "name": self.name}
+
+
+class FakeContainer(FakeObject):
+
+    def get_file(self, name):
+        for f in self.get("files", []):
+            if f.name == name:
+                return f
+        return None
+
+    def ref(self):
+        return {"type": self.container_type, "id": self.id}
+
+    def reload(self):
+        return self.client._get(self.id, "get_container")
+
+
+class FakeFinder:
+    """Mimics client.sessions / container.acquisitions (find, find_one, iter_find)."""
+
+    def __init__(self, client, items, name):
+        self.client = client
+        self.items = items
+        self.name = name
+
+    def __call__(self):
+        return self.find()
+
+    def find(self, filter=None, **kwargs):
+        self.client._call(self.name + ".find")
+        return list(self.items())
+
+    def iter_find(self, filter=None, **kwargs):
+        return iter(self.find(filter, **kwargs))
+
+    def iter(self):
+        return self.iter_find()
+
+    def find_one(self, filter=None, **kwargs):
+        items = self.find(filter, **kwargs)
+        return items[0] if items else None
+
+    def find_first(self, filter=None, **kwargs):
+        return self.find_one(filter, **kwargs)
+
+
+class FakeGear(FakeObject):
+
+    def get_default_config(self):
+        return {}
+
+    def is_analysis_gear(self):
+        return self.category == "analysis"
+
+    def run(self, config=None, analysis_label=None, tags=None, destination=None, inputs=None, **kwargs):
+        self.client._call("gear.run")
+        session = self.client.containers[destination.id]
+        analysis = self.client.add_analysis(session, self.gear.name, self.gear.version, analysis_label, state="pending")
+        return analysis.id
+
+
+class FakeJobFinder:
+
+    def __init__(self, client):
+        self.client = client
+
+    def find(self, filter=None, **kwargs):
+        self.client._call("jobs.find")
+        # "key=value" terms, "key=|[a,b]" matches any of the listed values
+        terms = {key: values.split(",") if "[" in term else [values]
+                 for term in re.findall(r"[^,\[]+=\|?(?:\[[^\]]*\]|[^,]*)", filter or "")
+                 for key, values in [re.sub(r"=\|?\[?", "=", term, count=1).rstrip("]").split("=", 1)]}
+        jobs = []
+        for analysis in self.client.all_analyses():
+            job = analysis.job
+            if "_id" in terms and job.id not in terms["_id"]:
+                continue
+            if "state" in terms and job.state not in terms["state"]:
+                continue
+            if "gear_info.name" in terms and analysis.gear_info.name not in terms["gear_info.name"]:
+                continue
+            if "tags" in terms and not set(terms["tags"]) & set(job.get("tags", [])):
+                continue
+            jobs.append(job)
+        return jobs
+
+    def iter_find(self, filter=None, **kwargs):
+        return iter(self.find(filter, **kwargs))
+
+
+class FakeClient:
+    """Fake flywheel client holding a synthetic hierarchy in memory.
+
+    Args:
+        latency (float): seconds every API call sleeps (simulated network round trip)
+        latencies (dict): per-call overrides, e.g. {"get_session": 0.2}
+    """
+
+    def __init__(self, latency=0.0, latencies=None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.containers = {}
+        self.gears = {}
+        self.sessions = FakeFinder(self, lambda: [c for c in self.containers.values() if c.container_type == "session"], "sessions")
+        self.projects = FakeFinder(self, lambda: [c for c in self.containers.values() if c.container_type == "project"], "projects")
+        self.jobs = FakeJobFinder(self)
+        self.batches = {}
+
+    # ---- bookkeeping ----
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        delay = self.latencies.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+
+    def _get(self, cid, name):
+        self._call(name)
+        try:
+            return self.containers[cid]
+        except KeyError:
+            raise ValueError(f"{name}: container {cid} not found")
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    # ---- flywheel.Client surface ----
+
+    def get_container(self, cid, **kwargs):
+        return self._get(cid, "get_container")
+
+    def get_session(self, cid, **kwargs):
+        return self._get(cid, "get_session")
+
+    def get_project(self, cid, **kwargs):
+        return self._get(cid, "get_project")
+
+    def get_subject(self, cid, **kwargs):
+        return self._get(cid, "get_subject")
+
+    def get_acquisition(self, cid, **kwargs):
+        return self._get(cid, "get_acquisition")
+
+    def get_analysis(self, cid, **kwargs):
+        self._call("get_analysis")
+        for analysis in self.all_analyses():
+            if analysis.id == cid:
+                return analysis
+        raise ValueError(f"get_analysis: analysis {cid} not found")
+
+    def get_job(self, jid, **kwargs):
+        self._call("get_job")
+        for analysis in self.all_analyses():
+            if analysis.job.id == jid:
+                return analysis.job
+        raise ValueError(f"get_job: job {jid} not found")
+
+    def lookup(self, path):
+        self._call("lookup")
+        parts = path.split("/")
+        if parts[0] != "gears":
+            raise ValueError(f"lookup: only gear paths are supported, not {path}")
+        versions = self.gears[parts[1]]
+        if len(parts) > 2:
+            return versions[parts[2]]
+        return max(versions.values(), key=lambda g: g.created)
+
+    def get_all_gears(self, all_versions=False, filter=None, **kwargs):
+        self._call("get_all_gears")
+        name = filter.split("=", 1)[1] if filter else None
+        return [g for n, versions in self.gears.items() if name in (None, n) for g in versions.values()]
+
+    def get_analyses(self, container_name, container_id, subcontainer_name, **kwargs):
+        self._call("get_analyses")
+        project = self.containers[container_id]
+        return [a for s in project.session_ids for a in self.containers[s].analyses]
+
+    def get_all_analyses(self, inflate_job=False, filter=None, limit=None, after_id=None, **kwargs):
+        self._call("get_all_analyses")
+        terms = dict(t.split("=", 1) for t in (filter or "").split(",") if "=" in t)
+        analyses = [a for a in self.all_analyses() if all(_lookup(a, key) == value for key, value in terms.items())]
+        if not inflate_job:
+            analyses = [FakeObject(a, job=a.job.id) for a in analyses]
+        return _page(analyses, limit, after_id)
+
+    def get_project_sessions(self, project_id, include_all_info=False, filter=None, limit=None, after_id=None, **kwargs):
+        self._call("get_project_sessions")
+        project = self.containers[project_id]
+        return _page([self.containers[s] for s in project.session_ids], limit, after_id)
+
+    def create_batch_job_from_jobs(self, proposal, **kwargs):
+        self._call("create_batch_job_from_jobs")
+        batch = FakeObject(id=new_id(), jobs=list(proposal.jobs), state="pending")
+        self.batches[batch.id] = batch
+        return batch
+
+    def start_batch(self, batch_id, **kwargs):
+        # premade jobs are started as given, their destination stays the session (no analysis)
+        self._call("start_batch")
+        batch = self.batches[batch_id]
+        batch["state"] = "running"
+        return [FakeObject(id=new_id(), gear_id=job.gear_id, label=job.label, state="pending", batch=batch_id,
+                           destination=FakeObject(job.destination)) for job in batch.jobs]
+
+    def delete_container_file(self, cid, name):
+        self._call("delete_container_file")
+        c = self.containers[cid]
+        c.files = [f for f in c.files if f.name != name]
+
+    # ---- synthetic data ----
+
+    def all_analyses(self):
+        for c in list(self.containers.values()):
+            for analysis in c.get("analyses", []):
+                yield analysis
+
+    def _container(self, container_type, **fields):
+        c = FakeContainer({"files": [], "analyses": [], "tags": [], "info": {}, "notes": [], **fields}, id=new_id(), container_type=container_type)
+        c["client"] = self
+        self.containers[c.id] = c
+        return c
+
+    def add_file(self, container, name, content=b""):
+        f = FakeFile(name=name, content=content, size=len(content), version=1, file_id=new_id(),
+                     hash=hashlib.sha384(content).hexdigest(), modified=datetime.now(timezone.utc))
+        f["client"] = self
+        f["parent"] = container
+        container.files.append(f)
+        return f
+
+    def add_gear(self, name, version, category="analysis"):
+        gear = FakeGear(id=new_id(), category=category, created=datetime.now(timezone.utc),
+                        gear=FakeObject(name=name, version=version))
+        gear["client"] = self
+        self.gears.setdefault(name, {})[version] = gear
+        return gear
+
+    def add_analysis(self, container, gear_name, gear_version, label, state="complete"):
+        job = FakeObject(id=new_id(), state=state, tags=[])
+        analysis = FakeObject(id=new_id(), label=label, job=job, files=[],
+                              gear_info=FakeObject(name=gear_name, version=gear_version),
+                              parents=FakeObject(container.get("parents", {}), **{container.container_type: container.id}),
+                              parent=FakeObject(type=container.container_type, id=container.id),
+                              created=datetime.now(timezone.utc))
+        container.analyses.append(analysis)
+        container["modified"] = datetime.now(timezone.utc)
+        return analysis
+
+    def make_project(self, template, n_sessions=10, n_acquisitions=5, n_analyses=3, label="bench", group="bench", seed=0):
+        """Builds a synthetic project with N sessions, M acquisitions per session and K analyses per session.
+
+        Gears and versions are taken from the template, which is uploaded as gears_template_JSON.txt.
+        Existing analyses are spread over the template steps with a mix of job states.
+        """
+        rng = random.Random(seed)
+        steps = template["analysis"]
+        for step in steps:
+            self.add_gear(step["gear-name"], step.get("gear-version", "1.0.0"))
+
+        project = self._container("project", label=label, group=group, parents=FakeObject(group=group), session_ids=[])
+        self.add_file(project, "gears_template_JSON.txt", json.dumps(template).encode())
+        for step in steps:
+            for spec in step.get("inputs", {}).values():
+                name = spec["value"] if "value" in spec else "bench" + spec["regex"].rstrip("$").replace("\\", "")
+                self.add_file(project, name, b"x")
+        project["sessions"] = FakeFinder(self, lambda: [self.containers[s] for s in project.session_ids], "project.sessions")
+
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for i in range(n_sessions):
+            subject = self._container("subject", label=f"sub-{i:04d}", parents=FakeObject(group=group, project=project.id))
+            parents = FakeObject(group=group, project=project.id, subject=subject.id)
+            session = self._container("session", label=f"ses-{i:04d}", subject=subject, parents=parents, project=project.id,
+                                      timestamp=start + timedelta(hours=i), created=start + timedelta(hours=i),
+                                      modified=start + timedelta(hours=i),
+                                      info={"COMPLETENESS": {"Run Downstream Analyses": rng.random() > 0.2}})
+            session.notes.append(FakeObject(text=f"note {i}"))
+            project.session_ids.append(session.id)
+
+            acquisitions = []
+            for j in range(n_acquisitions):
+                acq = self._container("acquisition", label=f"acq-{j}", parents=FakeObject(parents, session=session.id))
+                acquisitions.append(acq)
+            session["acquisitions"] = FakeFinder(self, lambda acquisitions=acquisitions: acquisitions, "session.acquisitions")
+
+            for k in range(n_analyses):
+                step = steps[k % len(steps)]
+                state = rng.choice(["complete", "complete", "complete", "failed", "running"])
+                label = step.get("custom-label", step["gear-name"]) + " bench"
+                self.add_analysis(session, step["gear-name"], step.get("gear-version", "1.0.0"), label, state)
+
+        return project
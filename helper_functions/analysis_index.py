@@ -0,0 +1,76 @@
+import logging
+import re
+from functools import lru_cache
+
+from helper_functions.client import fw
+
+log = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=256)
+def compile_regex(pattern):
+    return re.compile(pattern)
+
+
+class SessionAnalysisIndex:
+    """In-memory index of all session and acquisition level analyses of a session.
+
+    The index is built in a single pass (one fetch per acquisition) and then queried by
+    gear name, gear version regex, analysis label and job state, so repeated checks for
+    the same session do not go back to flywheel.
+
+    Args:
+        session (flywheel.Session): full flywheel session object (use fw.get_session(session.id))
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._session_analyses = []
+        self._acquisition_analyses = []
+        self.build()
+
+    def build(self):
+        # pull both session and acquisition level analyses ... acquisitions are fetched once here
+        self._session_analyses = list(self.session.analyses or [])
+        acq_analyses = [fw.get_acquisition(a.id).analyses for a in self.session.acquisitions.find()]
+        self._acquisition_analyses = [item for sublist in acq_analyses for item in sublist or []]
+        log.debug("Indexed %s session and %s acquisition analyses for session %s",
+                  len(self._session_analyses), len(self._acquisition_analyses), self.session.id)
+
+    def refresh_session(self):
+        # re-pull session level analyses only (new jobs are submitted to the session, acquisitions are unchanged)
+        self.session = fw.get_session(self.session.id)
+        self._session_analyses = list(self.session.analyses or [])
+        return self.session
+
+    def analyses(self, level=None):
+        if level == "session":
+            return self._session_analyses
+        if level == "acquisition":
+            return self._acquisition_analyses
+        return self._session_analyses + self._acquisition_analyses
+
+    def find(self, gear_name, version=None, label=None, states=None, level=None):
+        """Returns all indexed analyses that match the query, in flywheel order (session then acquisitions).
+
+        Args:
+            gear_name (str): exact gear name
+            version (str or re.Pattern): regular expression searched in the gear version
+            label (str): string that must be contained in the analysis label
+            states (list): job states to keep, analyses without a job state are always kept
+            level (str): "session" or "acquisition" to limit the search, default is both
+        """
+        r1 = compile_regex(version) if isinstance(version, str) else version
+        matches = []
+        for analysis in self.analyses(level):
+            if not analysis.gear_info or analysis.gear_info.name != gear_name:
+                continue
+            if r1 and not r1.search(analysis.gear_info["version"]):
+                continue
+            if label and label not in analysis.label:
+                continue
+            if states is not None and hasattr(analysis.job, 'state') and analysis.job.state not in states:
+                continue
+            matches.append(analysis)
+
+        return matches
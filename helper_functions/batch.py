@@ -0,0 +1,130 @@
+import logging
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flywheel.models import InputJob, PremadeJobsBatchProposalInput
+from flywheel.util import to_ref
+
+from helper_functions.client import fw
+
+log = logging.getLogger('main')
+
+
+def make_job(item):
+    # build a premade flywheel job from a collected (session, step) item, same config handling as gear.run
+    gear = item["gear"]
+    config = gear.get_default_config()
+    config.update(item["config"] or {})
+    return InputJob(
+        gear_id=gear.id,
+        inputs={key: to_ref(f) for key, f in (item["inputs"] or {}).items()},
+        destination=to_ref(item["session"]),
+        config=config,
+        tags=list(item["tags"] or []),
+        label=item["label"],
+    )
+
+
+def _describe(item):
+    return {"session": item["session"].id, "gear": item["gear"]["gear"]["name"], "label": item["label"]}
+
+
+def _job_key(destination_id, gear_id, label):
+    return (destination_id, gear_id, label)
+
+
+def submit_analysis(item):
+    """Submits an analysis gear item with gear.run, which creates the labelled analysis on the session.
+
+    Premade batch jobs have no analysis container, so analyses submitted that way would not be
+    found by their label (my_analysis_exists, prerequisites) on the next run.
+
+    Returns:
+        str: id of the analysis container
+    """
+    return item["gear"].run(analysis_label=item["label"], config=item["config"], inputs=item["inputs"],
+                            tags=item["tags"], destination=item["session"])
+
+
+def _submit_analyses(items, result, workers):
+    def submit(item):
+        try:
+            return item, submit_analysis(item), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item, analysis_id, error in pool.map(submit, items):
+            if error is None:
+                result["submitted"].append({**_describe(item), "job_id": analysis_id})
+            else:
+                log.error("Submission of %s for session %s failed: %s", item["label"], item["session"].id, error)
+                result["failed"].append({**_describe(item), "error": str(error)})
+
+
+def _submit_chunk(chunk, result):
+    # propose and start one batch of premade (utility gear) jobs
+    try:
+        proposal = fw.create_batch_job_from_jobs(PremadeJobsBatchProposalInput(jobs=[job for _, job in chunk]))
+        jobs = fw.start_batch(proposal.id)
+    except Exception as e:
+        log.error("Batch of %s jobs was rejected: %s", len(chunk), e)
+        result["failed"].extend({**_describe(item), "error": str(e)} for item, _ in chunk)
+        return
+
+    result["batches"].append(proposal.id)
+
+    # match started jobs back to the items by destination, gear and label; identical
+    # jobs (e.g. two steps of one gear on a session) are matched in the returned order
+    job_ids = defaultdict(deque)
+    for job in jobs or []:
+        job_ids[_job_key(job.destination.id, job.gear_id, getattr(job, "label", None))].append(job.id)
+    started = 0
+    for item, job in chunk:
+        queue = job_ids.get(_job_key(job.destination["id"], job.gear_id, job.label)) or job_ids.get(_job_key(job.destination["id"], job.gear_id, None))
+        if queue:
+            result["submitted"].append({**_describe(item), "job_id": queue.popleft()})
+            started += 1
+        else:
+            result["failed"].append({**_describe(item), "error": "job not started by batch " + proposal.id})
+
+    log.info("Batch %s: started %s of %s jobs", proposal.id, started, len(chunk))
+
+
+def submit_batch(items, chunk_size=100, workers=4):
+    """Submits collected (session, step) jobs, utility gears through flywheel batch proposals.
+
+    Utility gear jobs are sent in chunks of `chunk_size`: each chunk is proposed as one batch
+    of premade jobs and then started. Analysis gears are submitted one by one (`workers` at a
+    time) with gear.run, because a premade job can not create the labelled analysis the
+    workflow checks on later runs. Items that can not be turned into a job, and every item in
+    a chunk that flywheel rejects, are reported individually.
+
+    Args:
+        items (list): dicts with "session", "gear", "config", "inputs", "tags" and "label"
+            (as collected by gears.run_auto_gear(..., collect=items))
+        chunk_size (int): number of jobs per batch proposal
+        workers (int): analysis submissions sent at the same time
+
+    Returns:
+        dict: {"batches": [batch ids], "submitted": [{session, gear, label, job_id}], "failed": [{session, gear, label, error}]}
+            (job_id is the analysis id for analysis gears, as returned by gear.run)
+    """
+    result = {"batches": [], "submitted": [], "failed": []}
+
+    analyses = [item for item in items if item["gear"].is_analysis_gear()]
+    if analyses:
+        _submit_analyses(analyses, result, workers)
+
+    utility = [item for item in items if not item["gear"].is_analysis_gear()]
+    for start in range(0, len(utility), chunk_size):
+        chunk = []
+        for item in utility[start:start+chunk_size]:
+            try:
+                chunk.append((item, make_job(item)))
+            except Exception as e:
+                result["failed"].append({**_describe(item), "error": str(e)})
+
+        if chunk:
+            _submit_chunk(chunk, result)
+
+    return result
@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+
+log = logging.getLogger('main')
+
+# connection and retry policy of the shared client, set with configure() before the first API call
+#   request_timeout: seconds to wait for a response (long enough for large file transfers)
+#   connect_timeout: seconds to wait for a connection
+#   pool_size: connections kept alive for reuse, match it to the number of worker threads
+#   retries / backoff_factor / backoff_max: retries of transient errors (429, 502, 503, 504 and
+#       connection errors), sleeping backoff_factor * 2 ** retry seconds (at most backoff_max)
+#   api_key: flywheel api key, by default the one of the flywheel cli login
+#   auth_check: check the api key when the client is created (disable for drone or device keys)
+settings = {
+    "api_key": None,
+    "auth_check": True,
+    "request_timeout": int(os.getenv("FLYWHEEL_SDK_REQUEST_TIMEOUT", 6000)),
+    "connect_timeout": int(os.getenv("FLYWHEEL_SDK_CONNECT_TIMEOUT", 10)),
+    "pool_size": 16,
+    "retries": None,
+    "backoff_factor": None,
+    "backoff_max": None,
+}
+
+_client = None
+# True while _client was created here (from `settings`), False for one passed to set_client
+_created = False
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Updates the client policy (see `settings`), e.g. configure(pool_size=args.workers).
+
+    Takes effect for the client created on the next API call, a client created earlier is
+    replaced. A client passed to set_client is kept.
+    """
+    global _client, _created
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown client settings: {', '.join(sorted(unknown))}")
+    with _lock:
+        settings.update({key: value for key, value in kwargs.items() if value is not None})
+        if _created:
+            _client, _created = None, False
+
+
+def _apply_policy(client):
+    # rebuild the http client with the pool size and timeouts, then set the retry policy on its transports
+    import flywheel.rest
+
+    api_client = client.api_client
+    default = api_client.rest_client
+    api_client.rest_client = flywheel.rest.RESTClientObject(
+        api_client.configuration,
+        maxsize=settings["pool_size"],
+        request_timeout=settings["request_timeout"],
+        connect_timeout=settings["connect_timeout"],
+    )
+    if hasattr(default, "client"):
+        default.client.close()
+
+    http = getattr(api_client.rest_client, "client", None)
+    transports = [getattr(http, "_transport", None)] + list(getattr(http, "_mounts", {}).values())
+    for transport in transports:
+        if not isinstance(transport, getattr(flywheel.rest, "RetryTransport", ())):
+            continue
+        if settings["retries"] is not None:
+            transport.total = settings["retries"]
+        if settings["backoff_factor"] is not None:
+            transport.backoff_factor = settings["backoff_factor"]
+        if settings["backoff_max"] is not None:
+            transport.backoff_max = settings["backoff_max"]
+
+
+def get_client():
+    """Returns the process wide flywheel client, created (and authenticated) on first use."""
+    global _client, _created
+    with _lock:
+        if _client is None:
+            import flywheel
+
+            # the auth check is the first request, so it runs after the policy is in place
+            client = flywheel.Client(settings["api_key"] or '', disable_auth_check=True)
+            _apply_policy(client)
+            if settings["auth_check"]:
+                client.get_auth_status()
+            log.debug("Created flywheel client (pool %s, timeout %ss)", settings["pool_size"], settings["request_timeout"])
+            _client, _created = client, True
+        return _client
+
+
+def set_client(client):
+    # use an existing client object (e.g. one built with an explicit api key, or a test double)
+    global _client, _created
+    with _lock:
+        _client, _created = client, False
+
+
+class LazyClient:
+    """Stand-in for a flywheel.Client that creates the shared client on first attribute access.
+
+    Modules use `from helper_functions.client import fw` and call `fw.get_session(...)` as
+    with a regular client, all of them share one client and its connection pool.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
+
+    def __repr__(self):
+        return f"<LazyClient {_client!r}>"
+
+
+fw = LazyClient()
@@ -0,0 +1,94 @@
+import logging
+import threading
+
+from helper_functions.analysis_index import SessionAnalysisIndex
+from helper_functions.client import fw
+
+log = logging.getLogger(__name__)
+
+
+class SessionContext:
+    """Lazily loaded, memoized flywheel containers for the evaluation of one session.
+
+    Each container is fetched the first time it is used and then reused, so evaluating a
+    session costs one session fetch, one project fetch and one pass over the acquisitions
+    (for the analysis index) no matter how many checks and log lines use them. Call
+    refresh() to drop everything and fetch again on next use. Each container has its own
+    lock, so the project and the analysis index can be loaded from different threads at once.
+
+    Args:
+        session_id (str): flywheel container id (checked to be a session with `container_type`)
+        session (flywheel.Session): optional full session object already fetched by the caller
+    """
+
+    def __init__(self, session_id, session=None):
+        self.id = session_id
+        self._session = session
+        self._project = None
+        self._analyses = None
+        self._session_lock = threading.RLock()
+        self._project_lock = threading.RLock()
+        self._analyses_lock = threading.RLock()
+
+    @property
+    def container_type(self):
+        # the container is fetched with get_container so a non-session id costs a single call
+        with self._session_lock:
+            if self._session is None:
+                self._session = fw.get_container(self.id)
+            return self._session.container_type
+
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                self._session = fw.get_session(self.id)
+            return self._session
+
+    @property
+    def subject(self):
+        # subject label and id come with the full session, no extra fetch needed
+        return self.session.subject
+
+    @property
+    def project(self):
+        with self._project_lock:
+            if self._project is None:
+                self._project = fw.get_project(self.session.parents["project"])
+            return self._project
+
+    @property
+    def analyses(self):
+        # SessionAnalysisIndex of all session and acquisition analyses
+        with self._analyses_lock:
+            if self._analyses is None:
+                self._analyses = SessionAnalysisIndex(self.session)
+            return self._analyses
+
+    def refresh_session(self):
+        # re-pull the session (and its session level analyses) after a submission, project and acquisitions are kept
+        with self._analyses_lock, self._session_lock:
+            if self._analyses is not None:
+                self._session = self._analyses.refresh_session()
+            else:
+                self._session = fw.get_session(self.id)
+            return self._session
+
+    def refresh(self):
+        # locks are always taken in the order analyses, project, session
+        with self._analyses_lock, self._project_lock, self._session_lock:
+            self._session = None
+            self._project = None
+            self._analyses = None
+
+    def describe(self):
+        return "{}/{}/{}".format(self.project.label, self.subject.label, self.session.label)
+
+
+def as_context(session):
+    # accept a SessionContext, a full session object or a session id
+    if isinstance(session, SessionContext):
+        return session
+    if isinstance(session, str):
+        return SessionContext(session)
+    return SessionContext(session.id, session=session)
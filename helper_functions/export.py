@@ -0,0 +1,154 @@
+import csv
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# parquet column types of the status tables, every other column is written as a string
+PARQUET_TYPES = {"timestamp": "timestamp", "Run Downstream Analyses": "bool"}
+
+
+def sort_key(key):
+    # rows without a timestamp go last, same as DataFrame.sort_values
+    def row_key(row):
+        value = row.get(key)
+        return (value is None, value)
+    return row_key
+
+
+def _write_run(rows, directory, key):
+    # sort one chunk of rows and spill it to a temporary run file
+    rows.sort(key=key)
+    fd, path = tempfile.mkstemp(suffix=".run", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        for row in rows:
+            pickle.dump(row, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def external_sort(rows, key="timestamp", chunk_rows=10000, directory=None):
+    """Sorts a stream of row dicts with bounded memory.
+
+    Rows are collected in chunks of `chunk_rows`, each chunk is sorted and spilled to a
+    temporary run file, and the runs are merged back lazily. At most one chunk (plus one
+    row per run during the merge) is held in memory at any time.
+
+    Args:
+        rows (iterable): row dicts
+        key (str): column to sort by (None values last)
+        chunk_rows (int): rows held in memory before a run is written
+        directory (str): where run files are created, defaults to the system temp dir
+
+    Returns:
+        iterator: the rows ordered by `key` (stable)
+    """
+    row_key = sort_key(key)
+    with tempfile.TemporaryDirectory(dir=directory, prefix="table-sort-") as tmp:
+        runs = []
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            runs.append(_write_run(chunk, tmp, row_key))
+            del chunk
+        log.debug("merging %s sorted runs", len(runs))
+        yield from heapq.merge(*[_read_run(path) for path in runs], key=row_key)
+
+
+def _format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"unsupported export format: {fmt} (csv or parquet)")
+    return fmt
+
+
+def _parquet_schema(pa, columns):
+    types = {"timestamp": pa.timestamp("us", tz="UTC"), "bool": pa.bool_()}
+    return pa.schema([(name, types[PARQUET_TYPES[name]] if name in PARQUET_TYPES else pa.string()) for name in columns])
+
+
+def _write_csv(rows, path, columns, chunk_rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            writer.writerows(chunk)
+
+
+def _write_parquet(rows, path, columns, chunk_rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("parquet export needs pyarrow (pip install pyarrow), or export to .csv")
+
+    schema = _parquet_schema(pa, columns)
+    with pq.ParquetWriter(path, schema) as writer:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            # one row group per chunk, values that are not strings are cast (e.g. analysis ids)
+            data = {name: [row.get(name) for row in chunk] for name in columns}
+            for name in columns:
+                if name not in PARQUET_TYPES:
+                    data[name] = [None if v is None else str(v) for v in data[name]]
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+
+def write_table(rows, path, columns, fmt=None, sort_by="timestamp", chunk_rows=10000):
+    """Streams table rows to a CSV or Parquet file in `sort_by` order.
+
+    Rows are sorted with external_sort and written in chunks, so peak memory depends on
+    `chunk_rows` only, not on the number of rows.
+
+    Args:
+        rows (iterable): row dicts, e.g. tables.iter_template_rows(...)
+        path (str): output file, the format is taken from the extension unless `fmt` is given
+        columns (list): column names and order of the output
+        fmt (str): "csv" or "parquet" (needs pyarrow)
+        sort_by (str): column to order the rows by, None keeps the input order
+        chunk_rows (int): rows held in memory for sorting and per write
+
+    Returns:
+        int: number of rows written
+    """
+    fmt = _format(path, fmt)
+    count = itertools.count()
+    # count rows as they stream past
+    rows = (row for row, _ in zip(rows, count))
+    if sort_by:
+        rows = external_sort(rows, sort_by, chunk_rows, directory=os.path.dirname(os.path.abspath(path)))
+
+    # write to a temporary file first so an interrupted export never leaves a partial table
+    tmp_path = path + ".tmp"
+    try:
+        if fmt == "csv":
+            _write_csv(rows, tmp_path, columns, chunk_rows)
+        else:
+            _write_parquet(rows, tmp_path, columns, chunk_rows)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    written = next(count)
+    log.info("wrote %s rows to %s", written, path)
+    return written
@@ -1,17 +1,17 @@
-from pathlib import Path
 import subprocess as sp
-import sys, os, logging
-import flywheel
-from datetime import datetime, date
-import glob
-import pandas as pd
-from time import sleep
+import os, logging
 import time
-import re
+import fnmatch
+import shutil
+import stat
 import tempfile
+import threading
+from contextlib import contextmanager
 from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
+from helper_functions.file_cache import parse_file_hash, hash_file
+from helper_functions.client import fw
 
-fw = flywheel.Client('')
 log = logging.getLogger(__name__)
 
 
@@ -42,9 +42,53 @@ def searchfiles(path, dryrun=False, find_first=False):
             files = files[0]
 
         return files
-    
-    
-os.environ["FLYWHEEL_SDK_REQUEST_TIMEOUT"]="6000"
+
+
+def file_version(f):
+    # identifies one upload of a file, a re-uploaded file gets a new file id (and version)
+    return (f.get("file_id"), f.get("version"))
+
+
+def _is_listed(container, name, replaced):
+    f = container.get_file(name)
+    return bool(f) and (name not in replaced or file_version(f) != replaced[name])
+
+
+def wait_for_files(container, names, present=True, timeout=300, delay=0.5, max_delay=15, replaced=None):
+    """Reloads `container` with exponential backoff until all `names` are listed (or all gone).
+
+    Args:
+        container (flywheel container): container the files were uploaded to or deleted from
+        names (iterable): file names
+        present (bool): wait for the files to show up (True) or to disappear (False)
+        timeout (float): seconds before giving up with TimeoutError
+        delay (float): first wait, doubled after every poll up to `max_delay`
+        replaced (dict): name -> file_version() of an overwritten file, such a name only counts
+            as listed once the listed file is a new upload (the container may predate the delete)
+
+    Returns:
+        flywheel container: the reloaded container
+    """
+    names = set(names)
+    replaced = replaced or {}
+    start = time.monotonic()
+    while any(_is_listed(container, name, replaced) != present for name in names):
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"files {sorted(names)} still {'missing from' if present else 'in'} container {container.id} after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+        container = container.reload()
+    return container
+
+
+def _apply_metadata(f, update=True, replace_info=None, **kwargs):
+    if replace_info:
+        f.replace_info(replace_info)
+        log.info(f'Replacing info {list(replace_info.keys())} on file {f.name}')
+        
+    if update and kwargs:
+        f.update(**kwargs)
+
 
 def upload_file_to_container(conatiner, fp, overwrite=False, update=True, replace_info=[], **kwargs):
     """Upload file to FW container and update info if `update=True`
@@ -53,6 +97,7 @@ def upload_file_to_container(conatiner, fp, overwrite=False, update=True, replac
         container (flywheel.Project): A Flywheel Container (e.g. project, analysis, acquisition)
         fp (Path-like): Path to file to upload
         update (bool): If true, update container with key/value passed as kwargs.        
+        replace_info (dict): If set, replace the info of the uploaded file with it.
         kwargs (dict): Any key/value properties of Acquisition you would like to update.        
     """
     basename = os.path.basename(fp)
@@ -66,56 +111,389 @@ def upload_file_to_container(conatiner, fp, overwrite=False, update=True, replac
     if conatiner.get_file(basename) and overwrite:
         log.info(f'File {basename} already exists, overwriting.')
         fw.delete_container_file(conatiner.id,basename)
-        time.sleep(10)
+        conatiner = wait_for_files(conatiner, [basename], present=False)
         
     log.info(f'Uploading {fp} to container {conatiner.id}')
     conatiner.upload_file(fp)
-    while not conatiner.get_file(basename):   # to make sure the file is available before performing an update
-        conatiner = conatiner.reload()
-        time.sleep(1)
-    
-    f = conatiner.get_file(basename)
+    # to make sure the file is available before performing an update
+    conatiner = wait_for_files(conatiner, [basename])
     
-    if replace_info:
-        f.replace_info(replace_info)
-        log.info(f'Replacing info {info.keys()} to acquisition {acquistion.id}')
-        
-    if update and kwargs:
-        f.update(**kwargs)
+    _apply_metadata(conatiner.get_file(basename), update, replace_info, **kwargs)
 
 
-def download_session_analyses_byid(analysis_id, download_path):
-    # loop through all sessions in the project. More detailed filters could be 
-    #   used to specify a subset of sessions
-        
-    analysis = fw.get_container(analysis_id)
+def _upload_one(container, fp, overwrite, timeout):
+    # delete (if overwriting) and upload one file, returns its report entry
+    basename = os.path.basename(fp)
+    entry = {"path": str(fp), "name": basename, "bytes": os.path.getsize(fp), "status": "uploaded", "error": None, "replaced": None}
+    start = time.perf_counter()
+    try:
+        existing = container.get_file(basename)
+        if existing:
+            if not overwrite:
+                log.info(f'File {basename} already exists in container. Skipping.')
+                entry["status"] = "skipped"
+                return entry
+            log.info(f'File {basename} already exists, overwriting.')
+            entry["replaced"] = file_version(existing)
+            fw.delete_container_file(container.id, basename)
+            wait_for_files(container, [basename], present=False, timeout=timeout)
+        log.info(f'Uploading {fp} to container {container.id}')
+        container.upload_file(fp)
+    except Exception as e:
+        log.error("Upload of %s failed: %s", fp, e)
+        entry.update(status="failed", error=str(e))
+    finally:
+        entry["upload_seconds"] = time.perf_counter() - start
+    return entry
 
-    full_session = fw.get_container(analysis["parents"]["session"])
 
-    if analysis:
-        for fl in analysis.files:
-            if '.zip' in fl['name']:
-                download_and_unzip_inputs(analysis, fl, download_path)
-            else:
-                os.makedirs(os.path.join(download_path,'files'), exist_ok=True)
-                fl.download(os.path.join(download_path,'files',fl['name']))
+def upload_files_to_container(container, paths, overwrite=False, update=True, replace_info=None, workers=4, timeout=300, **kwargs):
+    """Uploads many files to one FW container concurrently.
+
+    Files are uploaded by `workers` threads. Availability of all uploaded files is then
+    polled together with exponential backoff (one container reload per poll), and the
+    metadata (`replace_info` and `update` with kwargs) is applied to every uploaded file
+    at the end.
+
+    Args:
+        container (flywheel container): A Flywheel Container (e.g. project, analysis, acquisition)
+        paths (list): Paths of the files to upload
+        overwrite (bool): replace files that already exist in the container (otherwise they are skipped)
+        update (bool): If true, update the files with key/value passed as kwargs.
+        replace_info (dict): If set, replace the info of every uploaded file with it.
+        workers (int): number of files uploaded at the same time
+        timeout (float): seconds to wait for deleted files to go and uploaded files to show up
+        kwargs (dict): Any key/value properties of the files you would like to update.
+
+    Returns:
+        dict: {"files": [{path, name, bytes, status, error, replaced, upload_seconds, available_seconds}], "seconds", "bytes"}
+    """
+    for fp in paths:
+        if not os.path.isfile(fp):
+            raise ValueError(f'{fp} is not file.')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        files = list(pool.map(lambda fp: _upload_one(container, fp, overwrite, timeout), paths))
+
+    uploaded = [entry for entry in files if entry["status"] == "uploaded"]
+    if uploaded:
+        # overwritten names are still listed in `container` (fetched before the deletes), wait for the new uploads
+        replaced = {entry["name"]: entry["replaced"] for entry in uploaded if entry["replaced"]}
+        container = wait_for_files(container, [entry["name"] for entry in uploaded], timeout=timeout, replaced=replaced)
+        available = time.perf_counter() - start
+        for entry in uploaded:
+            entry["available_seconds"] = available
+            _apply_metadata(container.get_file(entry["name"]), update, replace_info, **kwargs)
+
+    report = {"files": files, "seconds": time.perf_counter() - start, "bytes": sum(entry["bytes"] for entry in uploaded)}
+    log.info("Uploaded %s of %s files (%s skipped, %s failed) to container %s: %.1f MB in %.1f s",
+             len(uploaded), len(files), sum(e["status"] == "skipped" for e in files), sum(e["status"] == "failed" for e in files),
+             container.id, report["bytes"] / 1e6, report["seconds"])
+    for entry in files:
+        log.debug("%s: %s in %.2f s", entry["name"], entry["status"], entry["upload_seconds"])
+    return report
+
+
+def file_matches(local_path, file_obj):
+    """Returns True if `local_path` has the size and hash of the flywheel file record."""
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != file_obj.get("size"):
+        return False
+    algorithm, digest = parse_file_hash(file_obj.get("hash"))
+    if not digest:
+        return False
+    return hash_file(local_path, algorithm) == digest
 
-        log.info('Downloaded analysis: %s for Subject: %s Session: %s', analysis.label,full_session.subject.label, full_session.label)      
-    else:
-        log.info('Analysis not found: for Subject: %s Session: %s', full_session.subject.label, full_session.label)  
+
+# one lock per local path written by a download, so two downloads of the same name (e.g. report.html
+#   of two analyses) in this process take turns instead of writing over each other
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _path_lock(path):
+    with _path_locks_lock:
+        lock = _path_locks.setdefault(os.path.abspath(path), threading.Lock())
+    with lock:
+        yield
+
+
+def _temp_path(dest, suffix=".part"):
+    # unique hidden file next to `dest`, renamed into place once complete
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or ".", prefix="." + os.path.basename(dest) + ".", suffix=suffix)
+    os.close(fd)
+    os.chmod(tmp, 0o644)
+    return tmp
+
+
+def _download_to(dest, fetch):
+    # runs fetch(tmp) on a temporary file and moves it to `dest`, the temporary file is removed on failure
+    tmp = _temp_path(dest)
+    try:
+        result = fetch(tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return result
+
+
+def _fetch_file(file_obj, dest, cache=None):
+    # download_file, returns (bytes transferred, "local" if dest was kept, "cache" or "download")
+    with _path_lock(dest):
+        if file_matches(dest, file_obj):
+            log.debug("%s is up to date, skipping", dest)
+            return 0, "local"
+        if cache:
+            transferred = _download_to(dest, lambda tmp: cache.fetch(file_obj, tmp))
+        else:
+            def fetch(tmp):
+                file_obj.download(tmp)
+                return os.path.getsize(tmp)
+            transferred = _download_to(dest, fetch)
+    return transferred, "cache" if cache and not transferred and file_obj.get("size") else "download"
+
+
+def download_file(file_obj, dest, cache=None):
+    """Downloads a flywheel file unless `dest` already holds the same content.
+
+    The file is written to a unique temporary file next to `dest` and renamed into place
+    once complete, so an interrupted download never leaves a truncated file that looks
+    finished. Downloads to the same `dest` from several threads run one after the other.
+
+    Args:
+        file_obj (flywheel.FileEntry): file to download
+        dest (str): local path
+        cache (FileCache): optional local file cache, repeat downloads are served from it
+
+    Returns:
+        int: bytes transferred (0 if the local copy was kept or came from the cache)
+    """
+    return _fetch_file(file_obj, dest, cache)[0]
+
+
+def _download_analysis_file(analysis, fl, download_path, cache=None):
+    # one analysis file: zips are extracted, other files go to download_path/files; returns (bytes, source)
+    if '.zip' in fl['name']:
+        stats = download_and_unzip_inputs(analysis, fl, download_path, cache=cache)
+        return stats["bytes_transferred"], "cache" if stats.get("cached") else "download"
+    os.makedirs(os.path.join(download_path,'files'), exist_ok=True)
+    return _fetch_file(fl, os.path.join(download_path,'files',fl['name']), cache)
+
+
+def download_session_analyses_byid(analysis_ids, download_path, workers=4, cache=None):
+    """Downloads the files of one or more analyses into `download_path`.
+
+    Files of all analyses are downloaded concurrently by `workers` threads. Zip outputs are
+    extracted (see download_and_unzip_inputs), other files are written to
+    `download_path`/files, skipping files whose local size and hash already match flywheel,
+    so an interrupted run picks up where it stopped. Files of different analyses with the
+    same name are written one after the other (the last one is kept).
+
+    Args:
+        analysis_ids (str or list): flywheel analysis id(s)
+        download_path (str): destination directory shared by all analyses
+        workers (int): number of files downloaded at the same time
+        cache (FileCache): optional local file cache shared between download directories
+
+    Returns:
+        dict: {"files", "skipped", "cached", "bytes", "seconds"} totals over all analyses
+            ("skipped": local copy up to date, "cached": served from `cache`, "bytes": downloaded)
+    """
+    if isinstance(analysis_ids, str):
+        analysis_ids = [analysis_ids]
+
+    start = time.perf_counter()
+    stats = {"files": 0, "skipped": 0, "cached": 0, "bytes": 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # look up all analyses first, then queue every file of every analysis on the same pool
+        analyses = list(pool.map(fw.get_container, analysis_ids))
+        sessions = list(pool.map(lambda a: fw.get_container(a["parents"]["session"]), analyses))
+        pending = [(analysis, full_session, [pool.submit(_download_analysis_file, analysis, fl, download_path, cache) for fl in analysis.files])
+                   for analysis, full_session in zip(analyses, sessions) if analysis]
+
+        for analysis, full_session, futures in pending:
+            for future in futures:
+                transferred, source = future.result()
+                stats["files"] += 1
+                stats["skipped"] += source == "local"
+                stats["cached"] += source == "cache"
+                stats["bytes"] += transferred
+            log.info('Downloaded analysis: %s for Subject: %s Session: %s', analysis.label,full_session.subject.label, full_session.label)
+
+    stats["seconds"] = time.perf_counter() - start
+    log.info("Downloaded %s files (%s up to date, %s from cache) of %s analyses: %.1f MB in %.1f s (%.1f MB/s)",
+             stats["files"], stats["skipped"], stats["cached"], len(pending), stats["bytes"] / 1e6, stats["seconds"],
+             stats["bytes"] / 1e6 / stats["seconds"] if stats["seconds"] else 0)
+    return stats
 
 
         
-def download_and_unzip_inputs(parent_obj, file_obj, path):
+def _member_relpath(name, strip_top_dir=None):
+    # path of a zip member relative to the extraction dir ("" for the stripped top dir itself)
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if strip_top_dir and parts and parts[0] == strip_top_dir:
+        parts = parts[1:]
+    if ".." in parts or name.startswith("/"):
+        raise ValueError(f"unsafe path in zip archive: {name}")
+    return "/".join(parts)
+
+
+def _member_target(name, dest, strip_top_dir=None):
+    # destination path of a zip member, None for the stripped top dir itself
+    relpath = _member_relpath(name, strip_top_dir)
+    if not relpath:
+        return None
+    return os.path.join(dest, *relpath.split("/"))
+
+
+def _check_inside(path, root):
+    # refuses to write through a symbolic link that leads out of the extraction dir
+    real = os.path.realpath(path)
+    if real != root and not real.startswith(root + os.sep):
+        raise ValueError(f"unsafe path in zip archive: {path} resolves to {real}")
+
+
+def member_selector(include=None, exclude=None):
+    """Returns a filter for zip member paths (relative to the extraction dir).
+
+    A member is selected if it matches any of the `include` globs (all members if none are
+    given) and none of the `exclude` globs. Globs use fnmatch rules, "*" also matches "/".
+
+    Args:
+        include (list): globs, e.g. ["sub-*/anat/*.nii.gz", "*.html"]
+        exclude (list): globs, e.g. ["*/figures/*"]
+    """
+    include = [include] if isinstance(include, str) else list(include or [])
+    exclude = [exclude] if isinstance(exclude, str) else list(exclude or [])
+
+    def select(relpath):
+        if include and not any(fnmatch.fnmatchcase(relpath, pattern) for pattern in include):
+            return False
+        return not any(fnmatch.fnmatchcase(relpath, pattern) for pattern in exclude)
+    return select
+
+
+def extract_zip(zip_path, dest, strip_top_dir=None, select=None):
+    """Extracts a zip archive in-process, straight into `dest`.
+
+    Members are written to their final location, optionally with the top level directory
+    `strip_top_dir` removed from every path. Unix permissions, symbolic links and
+    modification times stored in the archive are restored (like `unzip -o`), existing
+    files are overwritten. Symbolic links are created after all other members, and
+    members whose directory resolves outside `dest` are refused (ValueError).
+
+    Args:
+        zip_path (str): local zip file
+        dest (str): directory to extract into
+        strip_top_dir (str): top level directory to drop from member paths (e.g. the analysis id)
+        select (callable): optional member filter on the stripped path, see member_selector
+
+    Returns:
+        int: number of members extracted
+    """
+    count = 0
+    dir_modes = []
+    links = []
+    root = os.path.realpath(dest)
+    with ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            target = _member_target(info.filename, dest, strip_top_dir)
+            if target is None:
+                continue
+            if select and not select(_member_relpath(info.filename, strip_top_dir)):
+                continue
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                _check_inside(target, root)
+                os.makedirs(target, exist_ok=True)
+                if mode:
+                    dir_modes.append((target, mode))
+                continue
+
+            _check_inside(os.path.dirname(target), root)
+            if stat.S_ISLNK(mode):
+                # links are created after all other members (like unzip), so no member is written through one
+                links.append((target, zf.read(info).decode("utf-8")))
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # replace existing files and links instead of writing through them (like unzip -o),
+            # so a read-only member from an earlier extraction does not block a re-run
+            if os.path.islink(target) or (os.path.lexists(target) and not os.path.isdir(target)):
+                os.remove(target)
+
+            with zf.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            if mode:
+                os.chmod(target, stat.S_IMODE(mode))
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(target, (mtime, mtime))
+            count += 1
+
+    for target, link in links:
+        _check_inside(os.path.dirname(target), root)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.islink(target) or (os.path.lexists(target) and not os.path.isdir(target)):
+            os.remove(target)
+        elif os.path.isdir(target):
+            # a directory of the archive is in the way (unzip skips these links too)
+            log.warning("Not creating link %s -> %s, a directory of that name exists", target, link)
+            continue
+        os.symlink(link, target)
+        count += 1
+
+    # directory permissions last, a read-only directory would otherwise block its own members
+    for target, mode in reversed(dir_modes):
+        os.chmod(target, stat.S_IMODE(mode))
+    return count
+
+
+def download_zip_members(parent_obj, file_obj, members, path, strip_top_dir=None):
+    # download single zip members through the flywheel zip member endpoint, each to a temporary file renamed into place
+    root = os.path.realpath(path)
+    for member in members:
+        target = _member_target(member.path, path, strip_top_dir)
+        _check_inside(os.path.dirname(target), root)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with _path_lock(target):
+            _download_to(target, lambda tmp: parent_obj.download_file_zip_member(file_obj.name, member.path, tmp))
+
+
+def download_and_unzip_inputs(parent_obj, file_obj, path, include=None, exclude=None, member_fraction=0.5, max_members=200, cache=None):
     """
     unzip_inputs unzips the contents of zipped gear output into the working
     directory.
+
+    Archive zips (analysis id as top dir) are extracted straight into `path` with the top
+    dir stripped, other zips into `path`/files. The zip is downloaded to a unique hidden
+    file next to its destination and removed once extracted, no temporary directory or
+    shell tools are used. Zips extracted into the same directory from several threads are
+    extracted one after the other.
+
+    With `include`/`exclude` globs (matched against the extracted paths) only matching
+    members are written. If they are a small part of the archive (at most `member_fraction`
+    of its uncompressed size and at most `max_members` files), they are fetched one by one
+    through the zip member endpoint instead of downloading the whole zip. Members fetched
+    that way are plain files: permissions and symbolic links are only restored from a full
+    download.
+
     Args:
-        zip_filename (string): The file to be unzipped
+        parent_obj (flywheel container): container holding the zip file (e.g. analysis)
+        file_obj (flywheel.FileEntry): The file to be unzipped
+        path (string): destination directory
+        include (list): globs of members to extract, default all
+        exclude (list): globs of members to leave out
+        member_fraction (float): largest share of the archive (uncompressed bytes) fetched member by member
+        max_members (int): largest number of members fetched member by member
+        cache (FileCache): optional local file cache for the zip (member downloads are not cached)
+
+    Returns:
+        dict: {"mode": "members" or "zip", "members": extracted, "bytes_transferred": downloaded bytes,
+            "bytes_skipped": uncompressed bytes of members left out, "cached": True if the zip came from `cache`}
     """
-    rc = 0
-    outpath = []
-    
     os.makedirs(path, exist_ok=True)
     
     # start by checking if zipped file
@@ -126,41 +504,42 @@ def download_and_unzip_inputs(parent_obj, file_obj, path):
     zip_info = parent_obj.get_file_zip_info(file_obj.name)
     zip_top_dir = zip_info.members[0].path.split('/')[0]
     if len(zip_top_dir)==24:
-        # this is an archive zip and needs to be handled special
-        with tempfile.TemporaryDirectory(dir=path) as tempdir:
-            zipfile = os.path.join(tempdir,file_obj.name)
-
-            # download zip
-            file_obj.download(zipfile)
-
-            # use linux "unzip" methods in shell in case symbolic links exist
-            log.info("Unzipping file, %s", os.path.basename(zipfile))
-            cmd = ["unzip","-qq","-o",zipfile,"-d",tempdir]
-            result = sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
-            log.info("Done unzipping.")
-
-            try:
-                # use subprocess shell command here since there is a wildcard
-                cmd = "mv "+os.path.join(tempdir,zip_top_dir,"*")+" "+path
-                result = sp.run(cmd, shell=True, check=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            except sp.CalledProcessError as e:
-                cmd = "cp -R "+os.path.join(tempdir,zip_top_dir,"*")+" "+path
-                result = sp.run(cmd, shell=True, check=True, stdout=sp.PIPE, stderr=sp.PIPE)
-            finally:
-                cmd = ['rm','-Rf',os.path.join(tempdir,zip_top_dir)]
-                run_command_with_retry(cmd, delay=5)
+        # this is an archive zip, the analysis id dir is stripped during extraction
+        strip_top_dir = zip_top_dir
     else:
+        strip_top_dir = None
         path = os.path.join(path,"files")
         os.makedirs(path, exist_ok=True)
-        zipfile = os.path.join(path,file_obj.name)
-        # download zip
-        file_obj.download(zipfile)
-        # use linux "unzip" methods in shell in case symbolic links exist
-        log.info("Unzipping file, %s", os.path.basename(zipfile))
-        cmd = ["unzip","-qq","-o",zipfile,"-d",path]
-        result = sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
-        log.info("Done unzipping.")
-        os.remove(zipfile)
+
+    # split the member listing by the include/exclude globs
+    select = member_selector(include, exclude) if include or exclude else None
+    files = [m for m in zip_info.members if not m.path.endswith("/") and _member_relpath(m.path, strip_top_dir)]
+    selected = [m for m in files if not select or select(_member_relpath(m.path, strip_top_dir))]
+    total_bytes = sum(m.size or 0 for m in files)
+    selected_bytes = sum(m.size or 0 for m in selected)
+    stats = {"members": len(selected), "bytes_skipped": total_bytes - selected_bytes, "cached": False}
+
+    if select and len(selected) <= max_members and selected_bytes <= member_fraction * total_bytes:
+        log.info("Downloading %s of %s members of %s", len(selected), len(files), file_obj.name)
+        download_zip_members(parent_obj, file_obj, selected, path, strip_top_dir)
+        stats.update(mode="members", bytes_transferred=selected_bytes)
+    else:
+        # download zip (unique hidden name so it never collides with an extracted member or another download)
+        zipfile = _temp_path(os.path.join(path, file_obj.name), ".download")
+        try:
+            transferred = cache.fetch(file_obj, zipfile) if cache else file_obj.download(zipfile)
+            log.info("Unzipping file, %s", file_obj.name)
+            with _path_lock(path):
+                stats["members"] = extract_zip(zipfile, path, strip_top_dir, select)
+            log.info("Done unzipping %s members.", stats["members"])
+        finally:
+            os.remove(zipfile)
+        stats.update(mode="zip", bytes_transferred=transferred if cache else file_obj.get("size") or 0,
+                     cached=bool(cache) and not transferred and bool(file_obj.get("size")))
+
+    log.info("%s: %s members, %s bytes transferred, %s bytes skipped",
+             file_obj.name, stats["members"], stats["bytes_transferred"], stats["bytes_skipped"])
+    return stats
         
 
 def run_command_with_retry(cmd, retries=3, delay=1, cwd=os.getcwd()):
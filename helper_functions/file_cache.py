@@ -0,0 +1,180 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import uuid
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# linux ioctl that clones a file's extents (copy-on-write copy on btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def parse_file_hash(value):
+    # flywheel file hashes look like "v0-sha384-<hex digest>", older records hold the bare sha384 hex digest
+    if not value:
+        return None, None
+    if value.startswith("v0-"):
+        _, algorithm, digest = value.split("-", 2)
+        return algorithm, digest
+    return "sha384", value
+
+
+def hash_file(path, algorithm="sha384"):
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def reflink(src, dest):
+    # copy-on-write clone of src, raises OSError where the filesystem does not support it
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def place(src, dest, modes=("reflink", "hardlink", "copy")):
+    """Makes `dest` a copy of the cached object `src` with the cheapest method that works.
+
+    Returns:
+        str: the method used
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    for mode in modes:
+        try:
+            if mode == "reflink":
+                reflink(src, dest)
+                os.chmod(dest, 0o644)
+            elif mode == "hardlink":
+                os.link(src, dest)
+            else:
+                shutil.copyfile(src, dest)
+                os.chmod(dest, 0o644)
+            return mode
+        except OSError as e:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            log.debug("%s of %s failed: %s", mode, src, e)
+    raise OSError(errno.EIO, f"could not place cached file {src} at {dest}")
+
+
+class FileCache:
+    """Content addressed local cache of flywheel files.
+
+    Files are stored once per content hash (the flywheel file record hash) under `root`
+    and placed into destinations by reflink, hardlink or, as a last resort, copy. Cached
+    objects are read-only, so a hardlinked destination can not corrupt the cache; write to
+    a copy if a destination has to be changed in place. When the cache grows over
+    `max_bytes` the least recently used objects are evicted.
+
+    Several processes can share a cache: downloads of the same file are serialized with
+    a per-object lock file and eviction holds a cache-wide lock (fcntl.flock).
+
+    Args:
+        root (str): cache directory, created if missing
+        max_bytes (int): size limit of the cached objects
+        modes (tuple): placement methods tried in order ("reflink", "hardlink", "copy")
+    """
+
+    def __init__(self, root, max_bytes=50 * 1024**3, modes=("reflink", "hardlink", "copy")):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.modes = modes
+        self.stats = {"hits": 0, "misses": 0, "uncacheable": 0, "evicted": 0}
+        for sub in ("objects", "tmp", "locks"):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    def path(self, algorithm, digest):
+        return os.path.join(self.root, "objects", algorithm, digest[:2], digest)
+
+    @contextmanager
+    def _lock(self, name):
+        with open(os.path.join(self.root, "locks", name + ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, file_obj, dest):
+        """Places the flywheel file at `dest`, downloading it into the cache on a miss.
+
+        Files without a hash are downloaded straight to `dest`.
+
+        Returns:
+            int: bytes transferred over the network (0 on a cache hit)
+        """
+        algorithm, digest = parse_file_hash(file_obj.get("hash"))
+        if not digest:
+            self.stats["uncacheable"] += 1
+            file_obj.download(dest)
+            return os.path.getsize(dest)
+
+        obj = self.path(algorithm, digest)
+        transferred = 0
+        with self._lock(digest):
+            if os.path.isfile(obj):
+                self.stats["hits"] += 1
+                # mtime marks the last use for LRU eviction
+                os.utime(obj)
+            else:
+                self.stats["misses"] += 1
+                transferred = self._download(file_obj, algorithm, digest, obj)
+                if not transferred:
+                    file_obj.download(dest)
+                    return os.path.getsize(dest)
+            mode = place(obj, dest, self.modes)
+        log.debug("%s %s from cache (%s)", "placed" if transferred else "reused", file_obj.name, mode)
+
+        if transferred:
+            self.evict()
+        return transferred
+
+    def _download(self, file_obj, algorithm, digest, obj):
+        # download into the cache, verified against the record hash; returns bytes, 0 if not cached
+        tmp = os.path.join(self.root, "tmp", uuid.uuid4().hex + ".part")
+        try:
+            file_obj.download(tmp)
+            if hash_file(tmp, algorithm) != digest:
+                log.warning("%s does not match its flywheel hash, not caching it", file_obj.name)
+                return 0
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(tmp, obj)
+            return os.path.getsize(obj)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path, _ in self._objects())
+
+    def _objects(self):
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, "objects")):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                yield path, os.stat(path)
+
+    def evict(self):
+        # remove least recently used objects until the cache fits in max_bytes, returns bytes freed
+        with self._lock("cache"):
+            objects = sorted(self._objects(), key=lambda o: o[1].st_mtime)
+            total = sum(st.st_size for _, st in objects)
+            freed = 0
+            for path, st in objects:
+                if total - freed <= self.max_bytes:
+                    break
+                with self._lock(os.path.basename(path)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                        freed += st.st_size
+                        self.stats["evicted"] += 1
+        if freed:
+            log.info("Evicted %.1f MB from file cache %s", freed / 1e6, self.root)
+        return freed
@@ -1,21 +1,19 @@
-from pathlib import Path
-import sys, subprocess, os, logging
-import flywheel
-import glob
-import pandas as pd
-from time import sleep
-import re
-import tempfile
+import logging
 import json
-from dateutil.tz import tzutc
+import threading
 from datetime import datetime, timedelta
+from helper_functions.resolver import resolve_gear
+from helper_functions.plan import compile_template, as_query, as_step
+from helper_functions.context import as_context
+from helper_functions.throttle import throttle
+from helper_functions.state import SETTLED, OPEN
+from helper_functions.job_monitor import monitor
+from helper_functions.client import fw
 
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
 
-fw = flywheel.Client('')
-
 ## Helper Function for getting date
 def get_x_days_ago(x, date=None):
     if date is None:
@@ -27,7 +25,7 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
     """Submits a job with specified gear and inputs.
     
     Args:
-        gear (flywheel.Gear): A Flywheel Gear.
+        gear (flywheel.Gear or str): A Flywheel Gear, or "gear-name/gear-version" to resolve through the gear cache.
         config (dict): Configuration dictionary for the gear.
         inputs (dict): Input dictionary for the gear.
         tags (list): List of tags for gear
@@ -38,6 +36,12 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         str: The id of the submitted job (for utility gear) or analysis container (for analysis gear).
         
     """
+    if isinstance(gear, str):
+        gear = resolve_gear(gear)
+
+    # the sdk is already loaded by the client that fetched the gear
+    from flywheel.rest import ApiException
+
     try:
         # Run the gear on the inputs provided, stored output in dest constainer and returns job ID
         if not analysis_label:
@@ -48,44 +52,58 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         log.debug('Submitted job %s', gear_job_id)
         
         return gear_job_id
-    except flywheel.rest.ApiException:
+    except ApiException:
         log.exception('An exception was raised when attempting to submit a job for %s',
-                      gear_job_id.name)
+                      gear['gear']['name'])
         
         
-def generate_inputs(session, template):
+def submitted_job_id(gear, submitted_id):
+    # run_gear returns the analysis id for analysis gears and the job id otherwise
+    if not gear.is_analysis_gear():
+        return submitted_id
+    job = fw.get_analysis(submitted_id).job
+    return job if isinstance(job, str) else job.id
+
+
+def generate_inputs(session, template, index=None):
+    # session can be a full session object or a SessionContext
+    # template can be a raw template step or a compiled StepPlan (see plan.compile_template)
+    ctx = as_context(session)
+    session = ctx.session
+    if index is None:
+        index = ctx.analyses
+    step = as_step(template)
     
     # if analysis should run - generate all inputs then run...
-    if "inputs" in template:
+    if step.inputs is not None:
         # initalize my inputs as dictionary
         myinputs = dict()
         
         # loop through all inputs in template
-        for key in template["inputs"]:
+        for spec in step.inputs:
+            key = spec.key
 
             # put input files in the format flywheel gear.run expects...
-            if "parent-container" in template["inputs"][key]:
-                fw_container = fw.get_container(session.parents[template["inputs"][key]["parent-container"]])
-            elif "find-analysis" in template["inputs"][key]:
-                fw_container = find_analysis(session, template["inputs"][key]["find-analysis"],status=["complete"])
+            if spec.parent_container:
+                fw_container = get_input_container(ctx, spec.parent_container)
             else:
-                log.error("Unable to interpret inputs: Project %s Subject %s Session %s %s ", project.label, full_session.subject.label, full_session.label, full_session.id)
+                fw_container = find_analysis(ctx, spec.find_analysis, status=["complete"], index=index)
+
+            if not fw_container:
+                raise ValueError(f"Unable to locate container for input {key}: Subject {session.subject.label} Session {session.label} {session.id}")
 
             # if 'value' key is passed for an input, just get the file from flywheel using given name"
-            if "value" in template["inputs"][key]:
-                file_found = fw_container.get_file(template["inputs"][key]["value"])
-                if "optional" in template["inputs"][key] and template["inputs"][key]["optional"] == True and not file_found:
+            if spec.value is not None:
+                file_found = fw_container.get_file(spec.value)
+                if spec.optional and not file_found:
                         pass
                 else:
-                    myinputs[key]=fw_container.get_file(template["inputs"][key]["value"])
+                    myinputs[key]=file_found
 
             # if 'regex' key is passed from an input, look for files matching the regular expression, save file if a match is found
-            elif "regex" in template["inputs"][key]:
+            elif spec.regex is not None:
 
-                namelist = [file['name'] for file in fw_container.files]
-
-                r1=re.compile(template["inputs"][key]["regex"])
-                matching_names = [x for x in namelist if r1.search(x)]
+                matching_names = match_input_files(fw_container, spec.regex, cache=spec.parent_container in SHARED_INPUT_LEVELS)
 
                 if len(matching_names) == 1:
                     myinputs[key]=fw_container.get_file(matching_names[0])
@@ -94,15 +112,11 @@ def generate_inputs(session, template):
                 elif len(matching_names) > 1:
                     log.debug("files found for analysis: %s"," ,".join(matching_names))
                     log.error("not sure which file to use, multiple matches...skipping")
-                    run_flag = False 
 
                 elif len(matching_names) < 1:
                     # check if input was optionl, if so, ok that is wasn't found, proceed
-                    if "optional" in template["inputs"][key] and template["inputs"][key]["optional"] == True:
-                        pass
-                    else:
+                    if not spec.optional:
                         log.error("unable to locate required file input...skipping")
-                        run_flag = False 
     else:
         myinputs = None
     
@@ -110,144 +124,114 @@ def generate_inputs(session, template):
 
 
 
-def my_analysis_exists(container, gear_info, status=["complete","running","pending"], status_bool_type="any", count_up_to_failures=1, analysis_label=None):
+def my_analysis_exists(container, gear_info, status=["complete","running","pending"], status_bool_type="any", count_up_to_failures=1, analysis_label=None, index=None):
     # Returns True if analysis already exists with a running or complete status, else false
     # make sure to pass full session object (use fw.get_session(session.id))
+    #   pass a SessionAnalysisIndex to reuse analyses already pulled for this session
     #
-    #Get all analyses for the session
     flag=False
     counter=0
     
-    #handle checks for any version of gear or specific version 
-    if "/" in gear_info:
-        gear_name = gear_info.split("/")[0]
-        gear_version = gear_info.split("/")[1]  # allow wildcard expressions here to check for multiple gear versions 
-    else:
-        gear_name = gear_info
-        gear_version = []
-        
+    #handle checks for any version of gear or specific version (allow wildcard expressions in version)
+    #   gear_info is "gear-name/gear-version" or a precompiled GearQuery
+    query = as_query(gear_info)
+
     # pull both session and acquisition level analyses to check... a bit slower but more complete.
-    acq_analyses = [ fw.get_acquisition(a.id).analyses for a in container.acquisitions.find()] # pull analyses from all acquisitions
-    acq_analyses = [item for sublist in acq_analyses for item in sublist] #flatten list of acquisitons
-    ses_analyses = container.analyses
-    all_analyses = ses_analyses+acq_analyses
+    if index is None:
+        index = as_context(container).analyses
     
-    # check all session analyses
-    for analysis in all_analyses:
-        if not analysis.gear_info:
-            continue
-        #only print ones that match the analysis label
-        if gear_name == analysis.gear_info.name:
-            if gear_version:
-                r1 = re.compile(gear_version)
-                if not r1.search(analysis.gear_info["version"]):
-                    continue
-            if analysis_label:
-                if analysis_label not in analysis.label:
-                    continue
-            #filter for only successful job
-            analysis_job=analysis.job
-            if not hasattr(analysis_job,'state'): 
-                flag=True
-            else:
-                if any(analysis_job.state in string for string in status):
-                    if analysis_job.state == "failed":
-                        counter += 1
-                        if counter >= count_up_to_failures:
-                            flag=True
-                    else:
+    # check all analyses matching the gear name, version and label
+    for analysis in index.find(query.gear_name, version=query.version_re, label=analysis_label):
+        #filter for only successful job
+        analysis_job=analysis.job
+        if not hasattr(analysis_job,'state'): 
+            flag=True
+        else:
+            if any(analysis_job.state in string for string in status):
+                if analysis_job.state == "failed":
+                    counter += 1
+                    if counter >= count_up_to_failures:
                         flag=True
                 else:
-                    # if any of the analyses that match name and version, but do not match status
-                    if status_bool_type == "all":
-                        return False
+                    flag=True
+            else:
+                # if any of the analyses that match name and version, but do not match status
+                if status_bool_type == "all":
+                    return False
     
     return flag
 
 
-def find_analysis(container, gear_info, status=["complete","running","pending"]):
-    # Returns analysis object if exists by analysis name in that container
+def find_analysis(container, gear_info, status=["complete","running","pending"], index=None):
+    # Returns analysis object if exists by analysis name in that container (last match wins)
     # make sure to pass full session object (use fw.get_session(session.id))
     #
    
-    #handle checks for any version of gear or specific version 
-    if "/" in gear_info:
-        gear_name = gear_info.split("/")[0]
-        gear_version = gear_info.split("/")[1]  # allow wildcard expressions here to check for multiple gear versions 
-    else:
-        gear_name = gear_info
-        gear_version = []
+    #handle checks for any version of gear or specific version (allow wildcard expressions in version)
+    query = as_query(gear_info)
     
-    #Get all analyses for the session
-    analys_obj = None
+    if index is None:
+        index = as_context(container).analyses
     
     # check all session analyses
-    for analysis in container.analyses:
-        
-        if not analysis.gear_info:
-            continue
-            
-        #only print ones that match the analysis label
-        if gear_name == analysis.gear_info.name:
-            if gear_version:
-                r1 = re.compile(gear_version)
-                if not r1.search(analysis.gear_info["version"]):
-                    continue
-                    
-            analysis_job=analysis.job
-            if not hasattr(analysis_job,'state'): 
-                analys_obj = analysis
-            else:
-                if any(analysis_job.state in string for string in status):
-                    analys_obj = analysis
-    
-    return analys_obj
+    matches = index.find(query.gear_name, version=query.version_re, states=status, level="session")
     
+    return matches[-1] if matches else None
     
     
-def my_checks(session, template):
     
-    my_gear_name=template["gear-name"]+"/"+template["gear-version"] if "gear-version" in template else template["gear-name"]
-    my_gear_label = template["custom-label"] if "custom-label" in template else template["gear-name"]
-    numfails = template["count-failures"] if "count-failures" in template else 1
+def my_checks(session, template, index=None, reasons=None):
+    # Returns True if all run conditions in the template are met
+    #   pass a list as `reasons` to collect why the analysis was skipped ("exists", "prerequisites", "completeness", "session-tags")
+    #   template can be a raw template step or a compiled StepPlan (see plan.compile_template)
+    #   session can be a full session object or a SessionContext (project is only fetched once for logging)
+    ctx = as_context(session)
+    session = ctx.session
+    step = as_step(template)
+    my_gear_label = step.label
     run_flag = True
+
+    # all checks read from the same analysis index (one pass over the session acquisitions)
+    if index is None:
+        index = ctx.analyses
     
     # 1. check if analysis already run 
-    if my_analysis_exists(session, my_gear_name, status=["complete","running","pending", "failed"], count_up_to_failures=numfails, analysis_label=my_gear_label):
-        log.info("EXISTING analysis found: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
+    if my_analysis_exists(session, step.gear, status=["complete","running","pending", "failed"], count_up_to_failures=step.count_failures, analysis_label=my_gear_label, index=index):
+        log.info("EXISTING analysis found: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, ctx.project.label, session.subject.label, session.label,session.id)
+        if reasons is not None: reasons.append("exists")
         return False 
 
     # 2. check if prerequisites are satisfied
-    if "prerequisites" in template:
-        for prereq in template["prerequisites"]:
-            prereq_gear_name = prereq["prereq-gear"]
-            prereq_gear_label = prereq["prereq-analysis-label"] if "prereq-analysis-label" in prereq else None
-            prereq_type = prereq["prereq-complete-analysis"] if "prereq-complete-analysis" in prereq else "any"
-            
-            if not my_analysis_exists(session, prereq_gear_name, status=["complete"],status_bool_type=prereq_type, analysis_label=prereq_gear_label):
-                log.info("PREREQUISITES not met: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
-                return False
+    for prereq in step.prerequisites:
+        if not my_analysis_exists(session, prereq.gear, status=["complete"],status_bool_type=prereq.mode, analysis_label=prereq.gear.label, index=index):
+            log.info("PREREQUISITES not met: Skipping... %s for Project %s Subject %s Session %s %s", my_gear_label, ctx.project.label, session.subject.label, session.label,session.id)
+            if reasons is not None: reasons.append("prerequisites")
+            return False
 
     # 3. check for any completeness or session tags
-    if "completeness-tags" in template:
+    if step.completeness_tags is not None:
         if "COMPLETENESS" not in session.info:
             run_flag = False
-            log.info("Completeness conditions not accessible ... Project %s Subject %s Session %s %s ", fw.get_project(session.parents["project"]).label, session.subject.label, session.label, session.id)
+            log.info("Completeness conditions not accessible ... Project %s Subject %s Session %s %s ", ctx.project.label, session.subject.label, session.label, session.id)
         else:
-            for tag in template["completeness-tags"]:
+            for tag in step.completeness_tags:
                 if not session.info["COMPLETENESS"][tag]:
                     run_flag = False
-                    log.info("Completeness condition not satified: %s ... Project %s Subject %s Session %s %s ",tag, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
+                    log.info("Completeness condition not satified: %s ... Project %s Subject %s Session %s %s ",tag, ctx.project.label, session.subject.label, session.label,session.id)
 
-    if run_flag == False: return False
+    if run_flag == False:
+        if reasons is not None: reasons.append("completeness")
+        return False
 
-    if "session-tags" in template:
-        for tag in template["session-tags"]:
+    if step.session_tags is not None:
+        for tag in step.session_tags:
             if tag not in session.tags:
                 run_flag = False
-                log.info("Missing Required session tag: %s ... Project %s Subject %s Session %s %s ",tag, fw.get_project(session.parents["project"]).label, session.subject.label, session.label,session.id)
+                log.info("Missing Required session tag: %s ... Project %s Subject %s Session %s %s ",tag, ctx.project.label, session.subject.label, session.label,session.id)
 
-    if run_flag == False: return False
+    if run_flag == False:
+        if reasons is not None: reasons.append("session-tags")
+        return False
 
     # if you reach this point, all checks passed...
     return True
@@ -268,63 +252,321 @@ def get_container_type(cid):
     return fw.get_container(cid).container_type
 
 
-def run_auto_gear(session_id, template_file_name = "gears_template_JSON.txt"):
+# template cache: parsed gear templates keyed by project id and template file name. Each entry
+#   remembers the fingerprint of the file it was parsed from so a re-uploaded template is re-read.
+_template_cache = {}
+_template_lock = threading.Lock()
+template_cache_stats = {"hits": 0, "misses": 0}
+
+
+def file_fingerprint(file_obj):
+    # Returns a string that changes whenever the flywheel file changes (hash if available, else version/modified)
+    if file_obj.get("hash"):
+        return file_obj.get("hash")
+    return "{}:{}".format(file_obj.get("version"), file_obj.get("modified"))
+
+
+def get_template(project, template_file_name="gears_template_JSON.txt"):
+    """Returns the parsed gear template stored in the project files.
+
+    The template is downloaded and parsed once per project, and only re-read if the
+    template file in flywheel changes (new hash or version).
+
+    Args:
+        project (flywheel.Project): full flywheel project object (use fw.get_project)
+        template_file_name (str): name of the template file attached to the project
+
+    Returns:
+        tuple: (template dict, template fingerprint) or (None, None) if the template was not found
+    """
+    entry = _get_template_entry(project, template_file_name)
+    if not entry:
+        return None, None
+    return entry["template"], entry["fingerprint"]
+
+
+def get_plan(project, template_file_name="gears_template_JSON.txt"):
+    """Returns the compiled rule plan for the gear template stored in the project files.
+
+    The template is validated and compiled once per template version (see get_template).
+
+    Returns:
+        tuple: (plan.RulePlan, template fingerprint) or (None, None) if the template was not found
+
+    Raises:
+        ValueError: if the template is invalid
+    """
+    entry = _get_template_entry(project, template_file_name)
+    if not entry:
+        return None, None
+    if entry["plan"] is None:
+        plan = compile_template(entry["template"], entry["fingerprint"])
+        with _template_lock:
+            entry["plan"] = plan
+    return entry["plan"], entry["fingerprint"]
+
+
+def _get_template_entry(project, template_file_name):
+    template_file = project.get_file(template_file_name)
+    if not template_file:
+        return None
+
+    key = (project.id, template_file_name)
+    fingerprint = file_fingerprint(template_file)
+
+    with _template_lock:
+        cached = _template_cache.get(key)
+        if cached and cached["fingerprint"] == fingerprint:
+            template_cache_stats["hits"] += 1
+            return cached
+        template_cache_stats["misses"] += 1
+
+    template = read_file_to_memory(template_file)
+    if template is None:
+        return None
+    entry = {"fingerprint": fingerprint, "template": template, "plan": None}
+    with _template_lock:
+        _template_cache[key] = entry
+    log.debug("Loaded template %s for project %s (%s)", template_file_name, project.label, fingerprint)
+
+    return entry
+
+
+def clear_template_cache():
+    with _template_lock:
+        _template_cache.clear()
+        template_cache_stats.update({"hits": 0, "misses": 0})
+
+
+# parent containers of session inputs (e.g. project level files) and the file names their input
+#   regexes matched, reused for every session of a run while the container `modified` is unchanged
+_input_cache = {}
+_match_cache = {}
+_input_lock = threading.Lock()
+input_cache_stats = {"hits": 0, "misses": 0}
+
+# input parents shared by several sessions, only their file matches are worth keeping for the run
+SHARED_INPUT_LEVELS = ("project", "subject")
+
+
+def _known_modified(ctx, level):
+    # `modified` of a parent container as already known from the session context, without an API call
+    if level == "subject":
+        return ctx.subject.get("modified")
+    return None
+
+
+def get_input_container(ctx, level):
+    """Returns the parent container (with its file listing) that holds a session input.
+
+    The session and project come from the session context (already fetched for the
+    evaluation). Other parents (e.g. subject) are fetched once per run and reused while
+    their `modified` timestamp, as seen in the session, is unchanged.
+
+    Args:
+        ctx (SessionContext): session being evaluated
+        level (str): parent container type ("project", "subject", "session", ...)
+    """
+    if level == "session":
+        return ctx.session
+    if level == "project":
+        return ctx.project
+
+    cid = ctx.session.parents[level]
+    modified = _known_modified(ctx, level)
+    with _input_lock:
+        cached = _input_cache.get(cid)
+        if cached and modified is not None and cached["modified"] == modified:
+            input_cache_stats["hits"] += 1
+            return cached["container"]
+        input_cache_stats["misses"] += 1
+
+    container = fw.get_container(cid)
+    with _input_lock:
+        _input_cache[cid] = {"modified": container.get("modified"), "container": container}
+    return container
+
+
+def match_input_files(container, regex, cache=True):
+    # names of the container files matching an input regex, with `cache` computed once per container version and regex
+    names = lambda: [file['name'] for file in container.files if regex.search(file['name'])]
+    if not cache:
+        return names()
+
+    key = (container.id, str(container.get("modified")), regex.pattern)
+    with _input_lock:
+        if key in _match_cache:
+            input_cache_stats["hits"] += 1
+            return _match_cache[key]
+        input_cache_stats["misses"] += 1
+    matched = names()
+    with _input_lock:
+        _match_cache[key] = matched
+    return matched
+
+
+def clear_input_cache():
+    with _input_lock:
+        _input_cache.clear()
+        _match_cache.clear()
+        input_cache_stats.update({"hits": 0, "misses": 0})
+
+
+def step_is_settled(index, step, reasons):
+    # Returns True if a skipped step needs no more work until the session or template changes
+    if reasons != ["exists"]:
+        # completeness / session tags only change with the session, prerequisites may still complete
+        return bool(reasons) and reasons[0] in ("completeness", "session-tags")
+    # a pending or running analysis may still fail and need a retry
+    active = [a for a in index.find(step.gear_name, version=step.gear.version_re, label=step.label) if getattr(a.job, 'state', None) in ("pending", "running")]
+    return not active
+
+
+def load_plan(ctx, template_file_name="gears_template_JSON.txt"):
+    # compiled template plan of the session's project, None (and logged) if the project has no template
+    project = ctx.project
+    plan, _ = get_plan(project, template_file_name)
+    if not plan:
+        log.info(f"{template_file_name} not found within project: {project.label}. Skipping...")
+    return plan
+
+
+def run_step(ctx, plan, index, step, collect=None):
+    """Checks one template step for a session and submits (or collects) its analysis if approved.
+
+    Returns:
+        bool: True if the step may still need work (the session stays open)
+    """
+    full_session = ctx.session
+    project = ctx.project
+
+    # get gear for analysis (check for optional template entry "gear version" to include in gear descrip)
+    gear = resolve_gear(step.gear_key)
+
+    # generate analysis label
+    mylabel = step.custom_label or gear['gear']['name']
+
+    # ------------------------------- #
+    # ----------- checks ------------ #
+    # ------------------------------- #
+    
+    # 1. check for exisiting analyses...
+    reasons = []
+    if not my_checks(ctx, step, index=index, reasons=reasons):
+        return not step_is_settled(index, step, reasons)
+
+    # anything past the checks (submitted or held back) needs to be looked at again next run
+    
+    # ------------------------------- #
+    # ------------ run -------------- #
+    # ------------------------------- #
+                               
+    # label for new analysis....
+    mylabel = mylabel+datetime.now().strftime(" %x %X")
+    
+    # pull inputs
+    myinputs = generate_inputs(ctx, step, index=index)
+                                  
+    # pull config
+    myconfig = dict(step.config)
+
+    # pull tags
+    mytags = list(step.tags)
+
+    # batch mode: hand the job over to the caller instead of submitting it here
+    if collect is not None:
+        collect.append({"session": full_session, "step": step.index, "gear": gear, "config": myconfig,
+                        "inputs": myinputs, "tags": mytags, "label": mylabel})
+        log.info('QUEUED gear for batch: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+        return True
+
+    # only wait here if the job queue is saturated for this gear or one of its tags
+    if not throttle.wait(step.gear_name, mytags, gear_limit=step.max_inflight, tag_limits=plan.max_inflight_tags):
+        log.info("QUEUE saturated: Skipping... %s for Project %s Subject %s Session %s %s", mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+        return True
+
+    submitted = run_gear(gear, myconfig, myinputs, mytags, full_session, analysis_label=mylabel)
+    throttle.record_submission(step.gear_name, mytags)
+    log.info('RUNNING gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
+
+    # light weight gears: when a later step waits on this gear as a prerequisite, wait (at most
+    # sleep_seconds) for the job to finish so that step can run in this pass
+    if submitted and step.sleep_seconds and step.has_dependents:
+        monitor.wait([submitted_job_id(gear, submitted)], timeout=step.sleep_seconds)
+
+    # pull session info again after a submission so the next steps see the new analysis
+    ctx.refresh_session()
+    return True
+
+
+def run_auto_gear(session_id, template_file_name = "gears_template_JSON.txt", collect=None):
+    """Applies the project gear template to a session and submits analyses whose run conditions are met.
+
+    `session_id` can also be a SessionContext, so containers already fetched by the caller are reused.
+
+    If a list is passed as `collect`, approved analyses are appended to it (session, gear, config,
+    inputs, tags, label) instead of being submitted, so they can be sent together with batch.submit_batch.
+
+    Returns:
+        str: "settled" if every template step is finished for this session (nothing to re-check until the
+            session or template changes), "open" if any step may still need work, None if the session was skipped
+    """
     
+    ctx = as_context(session_id)
+
     # check id passed is a session id, if not abort
-    if get_container_type(session_id) != 'session':
-        log.info("Flywheel Container %s is a %s... not session. Skipping", session_id, get_container_type(session_id))
+    if ctx.container_type != 'session':
+        log.info("Flywheel Container %s is a %s... not session. Skipping", ctx.id, ctx.container_type)
         return
     
-    full_session=fw.get_session(session_id)
-    project = fw.get_project(full_session["parents"]["project"])
-         
-    template_file = project.get_file(template_file_name)
-    if not template_file:
-        log.info(f"{template_file_name} not found within project: {project.label}. Skipping...")
+    plan = load_plan(ctx, template_file_name)
+    if not plan:
         return
-    template = read_file_to_memory(template_file)
+
+    # index all session and acquisition analyses once, checks for every step read from here
+    index = ctx.analyses
+
+    outcome = SETTLED
     
-    # run each analysis...based on conditions in template
-    for itr, json in enumerate(template["analysis"]):
-        
-        # pull session and project info at the beggining of each gear call in case changes have occured
-        full_session=fw.get_session(session_id)
+    # run each analysis...based on conditions in template (steps are compiled once per template version)
+    for step in plan.steps:
+        if run_step(ctx, plan, index, step, collect):
+            outcome = OPEN
+                                      
+    return outcome
 
-        # get gear for analysis (check for optional template entry "gear version" to include in gear descrip)
-        my_gear_name = json["gear-name"]+"/"+json["gear-version"] if "gear-version" in json else json["gear-name"]
-        gear = fw.lookup("gears"+"/"+my_gear_name)
 
-        # generate analysis label
-        mylabel = json["custom-label"] if "custom-label" in json else gear['gear']['name']
+async def run_auto_gear_async(session_id, call, template_file_name = "gears_template_JSON.txt", collect=None):
+    """Asyncio variant of run_auto_gear, with the same checks, decisions and step order.
 
-        # ------------------------------- #
-        # ----------- checks ------------ #
-        # ------------------------------- #
-        
-        # 1. check for exisiting analyses...
-        if not my_checks(full_session, json):
-            continue
-        
-        # ------------------------------- #
-        # ------------ run -------------- #
-        # ------------------------------- #
-                                   
-        # label for new analysis....
-        mylabel = mylabel+datetime.now().strftime(" %x %X")
-        
-        # pull inputs
-        myinputs = generate_inputs(full_session, json)
-                                      
-        # pull config
-        myconfig = json["config"]
+    Blocking flywheel work runs through `call(fn, *args)`, which returns an awaitable (see
+    runner.run_sessions_async). Loading the template plan and indexing the session's
+    analyses overlap, and all step gears are resolved together; the steps themselves run
+    one after the other since each one sees the analyses submitted by the previous ones.
+    While one session waits on flywheel, other sessions' stages run.
 
-        # pull tags
-        mytags = json["tags"]
+    Returns:
+        str: SETTLED, OPEN or None, as run_auto_gear
+    """
+    ctx = as_context(session_id)
 
-        run_gear(gear, myconfig, myinputs, mytags, full_session, analysis_label=mylabel)
-        log.info('RUNNING gear: %s Project %s Subject %s, Session %s %s ', mylabel, project.label, full_session.subject.label, full_session.label, full_session.id)
-        sleep(json["sleep_seconds"])
-                                      
-    return
-                                      
-        
\ No newline at end of file
+    # check id passed is a session id, if not abort
+    container_type = await call(lambda: ctx.container_type)
+    if container_type != 'session':
+        log.info("Flywheel Container %s is a %s... not session. Skipping", ctx.id, container_type)
+        return
+
+    import asyncio
+
+    plan, index = await asyncio.gather(call(load_plan, ctx, template_file_name), call(lambda: ctx.analyses))
+    if not plan:
+        return
+
+    await asyncio.gather(*(call(resolve_gear, step.gear_key) for step in plan.steps))
+
+    outcome = SETTLED
+    for step in plan.steps:
+        if await call(run_step, ctx, plan, index, step, collect):
+            outcome = OPEN
+
+    return outcome
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait as wait_futures
+from helper_functions.client import fw
+
+log = logging.getLogger('main')
+
+FINISHED_STATES = ["complete", "failed", "cancelled"]
+
+
+class JobMonitor:
+    """Waits on many flywheel jobs with one bulk query per tick.
+
+    Watched jobs are polled by a background thread. Each tick asks flywheel only for the
+    watched jobs that have finished, in chunks of `chunk_size` ids per `jobs.find`. The time
+    between ticks grows with the age of the youngest watched job (a tenth of its age, from
+    the job's poll interval up to `max_poll_seconds`), so long running jobs are not polled
+    every second; watching a new job brings the next tick forward to its poll interval.
+
+    Every watched job gets a concurrent.futures.Future, resolved with the finished job
+    (its `state` is one of FINISHED_STATES). Use callbacks, futures or `await
+    monitor.wait_async(job_id)` to chain downstream work. A job is watched until it finishes
+    or until every wait() on it timed out.
+
+    Args:
+        poll_seconds (float): default shortest time between checks of a job
+        max_poll_seconds (float): longest time between ticks
+        chunk_size (int): job ids per jobs.find query
+    """
+
+    def __init__(self, poll_seconds=2, max_poll_seconds=60, chunk_size=100):
+        self.poll_seconds = poll_seconds
+        self.max_poll_seconds = max_poll_seconds
+        self.chunk_size = chunk_size
+        self.stats = {"ticks": 0, "queries": 0, "finished": 0}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, job_id, callback=None, poll_seconds=None):
+        """Starts watching a job.
+
+        Args:
+            job_id (str): flywheel job id
+            callback (callable): optional, called with the finished job (from the monitor thread)
+            poll_seconds (float): shortest time between checks for this job, defaults to the monitor's
+
+        Returns:
+            concurrent.futures.Future: resolved with the finished job
+        """
+        poll_seconds = poll_seconds or self.poll_seconds
+        with self._lock:
+            if job_id not in self._jobs:
+                self._jobs[job_id] = {"future": Future(), "since": time.monotonic(), "poll": poll_seconds, "waiters": 0}
+            entry = self._jobs[job_id]
+            entry["poll"] = min(entry["poll"], poll_seconds)
+            entry["waiters"] += 1
+            future = entry["future"]
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="job-monitor", daemon=True)
+                self._thread.start()
+        if callback:
+            future.add_done_callback(lambda f: f.cancelled() or callback(f.result()))
+        self._wake.set()
+        return future
+
+    def watch_all(self, job_ids, callback=None, poll_seconds=None):
+        return [self.watch(job_id, callback, poll_seconds) for job_id in job_ids]
+
+    def unwatch(self, job_ids):
+        # drop one watcher of each job, a job nobody watches any more is no longer polled (its future is cancelled)
+        with self._lock:
+            for job_id in job_ids:
+                entry = self._jobs.get(job_id)
+                if not entry:
+                    continue
+                entry["waiters"] -= 1
+                if entry["waiters"] <= 0:
+                    del self._jobs[job_id]
+                    entry["future"].cancel()
+
+    def wait(self, job_ids, timeout=None, poll_seconds=None):
+        """Blocks until all jobs finished or `timeout` seconds passed.
+
+        Jobs still running at the timeout are unwatched (unless someone else waits on them).
+
+        Args:
+            job_ids (str or list): flywheel job id(s)
+            timeout (float): seconds to wait, None waits until all jobs finished
+            poll_seconds (float): shortest time between checks for these jobs, defaults to the monitor's
+
+        Returns:
+            bool: True if every job finished
+        """
+        if isinstance(job_ids, str):
+            job_ids = [job_ids]
+        # one watcher per job, so a timeout releases every watcher this wait added
+        job_ids = list(dict.fromkeys(job_ids))
+        futures = dict(zip(self.watch_all(job_ids, poll_seconds=poll_seconds), job_ids))
+        _, not_done = wait_futures(list(futures), timeout=timeout)
+        self.unwatch([futures[future] for future in not_done])
+        return not not_done
+
+    async def wait_async(self, job_id):
+        # awaitable variant of watch(), returns the finished job
+        import asyncio
+
+        return await asyncio.wrap_future(self.watch(job_id))
+
+    def pending(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def poll(self):
+        """Runs one tick: fetches finished watched jobs in bulk and resolves their futures.
+
+        Returns:
+            int: number of jobs that finished in this tick
+        """
+        job_ids = self.pending()
+        self.stats["ticks"] += 1
+        finished = []
+        for start in range(0, len(job_ids), self.chunk_size):
+            chunk = job_ids[start:start+self.chunk_size]
+            query = "_id=|[{}],state=|[{}]".format(",".join(chunk), ",".join(FINISHED_STATES))
+            self.stats["queries"] += 1
+            finished.extend(fw.jobs.find(query))
+
+        for job in finished:
+            with self._lock:
+                entry = self._jobs.pop(job.id, None)
+            if entry:
+                log.info('Job %s: completed with status: %s', job.id, job.state)
+                self.stats["finished"] += 1
+                entry["future"].set_result(job)
+        return len(finished)
+
+    def _delay(self):
+        # poll young jobs often (each at most every `poll` seconds), back off as the watched jobs age
+        now = time.monotonic()
+        with self._lock:
+            if not self._jobs:
+                return None
+            delay = min(max(entry["poll"], (now - entry["since"]) / 10) for entry in self._jobs.values())
+        return min(delay, self.max_poll_seconds)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                # keep polling, an exception here would leave every waiter hanging
+                log.warning("Job monitor query failed, retrying: %s", e)
+            delay = self._delay()
+            if delay is None:
+                with self._lock:
+                    if not self._jobs:
+                        self._thread = None
+                        return
+                continue
+            # sleep until the next tick, or until a new job is watched
+            if self._wake.wait(delay):
+                time.sleep(self.poll_seconds)
+
+
+# shared monitor, so all waiters in a process are served by the same bulk queries
+monitor = JobMonitor()
@@ -0,0 +1,251 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Optional, Pattern, Tuple
+
+from helper_functions.resolver import split_gear_info
+
+log = logging.getLogger('main')
+
+PARENT_CONTAINERS = ("project", "subject", "session", "acquisition", "analysis", "group")
+
+
+@dataclass(frozen=True)
+class GearQuery:
+    """Gear name with an optional precompiled version regex, used to look up existing analyses."""
+    gear_name: str
+    gear_version: Optional[str] = None
+    version_re: Optional[Pattern] = None
+    label: Optional[str] = None
+
+    @property
+    def gear_key(self):
+        return self.gear_name+"/"+self.gear_version if self.gear_version else self.gear_name
+
+
+@dataclass(frozen=True)
+class PrereqSpec:
+    gear: GearQuery
+    mode: str = "any"
+
+
+@dataclass(frozen=True)
+class InputSpec:
+    key: str
+    parent_container: Optional[str] = None
+    find_analysis: Optional[GearQuery] = None
+    value: Optional[str] = None
+    regex: Optional[Pattern] = None
+    optional: bool = False
+
+
+@dataclass(frozen=True)
+class StepPlan:
+    """One compiled workflow step (one entry of template["analysis"])."""
+    index: int
+    gear: GearQuery
+    label: str
+    custom_label: Optional[str]
+    count_failures: int
+    config: MappingProxyType
+    tags: Tuple[str, ...]
+    inputs: Optional[Tuple[InputSpec, ...]]
+    prerequisites: Tuple[PrereqSpec, ...]
+    completeness_tags: Optional[Tuple[str, ...]]
+    session_tags: Optional[Tuple[str, ...]]
+    sleep_seconds: float = 0
+    max_inflight: Optional[int] = None
+    depends_on: Tuple[int, ...] = ()
+    has_dependents: bool = False
+
+    @property
+    def gear_name(self):
+        return self.gear.gear_name
+
+    @property
+    def gear_key(self):
+        return self.gear.gear_key
+
+
+@dataclass(frozen=True)
+class RulePlan:
+    """Compiled gear template: validated steps in template order plus the step dependency graph."""
+    steps: Tuple[StepPlan, ...]
+    max_inflight_tags: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+    fingerprint: Optional[str] = None
+
+    def table_columns(self):
+        # {gear-name/gear-version: analysis label} for each step, as used for status tables
+        return {step.gear_key: step.label for step in self.steps}
+
+
+def _regex(pattern, where):
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"{where}: invalid regular expression {pattern!r} ({e})")
+
+
+def compile_gear_query(gear_info, label=None, where="template"):
+    # "gear-name/gear-version" -> GearQuery, gear-version is a regular expression
+    gear_name, gear_version = split_gear_info(gear_info)
+    if not gear_name:
+        raise ValueError(f"{where}: missing gear name in {gear_info!r}")
+    version_re = _regex(gear_version, where) if gear_version else None
+    return GearQuery(gear_name, gear_version, version_re, label)
+
+
+def _compile_input(key, spec, where):
+    where = f"{where} input {key}"
+    if "parent-container" in spec:
+        if spec["parent-container"] not in PARENT_CONTAINERS:
+            raise ValueError(f"{where}: unknown parent-container {spec['parent-container']!r}")
+        find = None
+    elif "find-analysis" in spec:
+        find = compile_gear_query(spec["find-analysis"], where=where)
+    else:
+        raise ValueError(f"{where}: one of 'parent-container' or 'find-analysis' is required")
+
+    if "value" not in spec and "regex" not in spec:
+        raise ValueError(f"{where}: one of 'value' or 'regex' is required")
+
+    return InputSpec(
+        key=key,
+        parent_container=spec.get("parent-container"),
+        find_analysis=find,
+        value=spec.get("value"),
+        regex=_regex(spec["regex"], where) if "value" not in spec and "regex" in spec else None,
+        optional=spec.get("optional") == True,
+    )
+
+
+def compile_step(template, index=0, gear_limits=None):
+    """Validates one template step and returns it as an immutable StepPlan.
+
+    Args:
+        template (dict): one entry of template["analysis"]
+        index (int): position of the step in the template
+        gear_limits (dict): template wide {gear-name: max in-flight jobs}
+
+    Raises:
+        ValueError: if the step is missing required entries or has an invalid regular expression
+    """
+    where = f"analysis step {index+1}"
+    if "gear-name" not in template:
+        raise ValueError(f"{where}: 'gear-name' is required")
+
+    gear_info = template["gear-name"]+"/"+template["gear-version"] if "gear-version" in template else template["gear-name"]
+    custom_label = template.get("custom-label")
+    label = custom_label or template["gear-name"]
+
+    prereqs = []
+    for prereq in template.get("prerequisites", []):
+        if "prereq-gear" not in prereq:
+            raise ValueError(f"{where}: prerequisite without 'prereq-gear'")
+        mode = prereq.get("prereq-complete-analysis", "any")
+        if mode not in ("any", "all"):
+            raise ValueError(f"{where}: prereq-complete-analysis must be 'any' or 'all', not {mode!r}")
+        prereqs.append(PrereqSpec(compile_gear_query(prereq["prereq-gear"], prereq.get("prereq-analysis-label"), where), mode))
+
+    if "inputs" in template:
+        inputs = tuple(_compile_input(key, spec, where) for key, spec in template["inputs"].items())
+    else:
+        inputs = None
+
+    max_inflight = template.get("max-inflight", (gear_limits or {}).get(template["gear-name"]))
+
+    return StepPlan(
+        index=index,
+        gear=compile_gear_query(gear_info, label, where),
+        label=label,
+        custom_label=custom_label,
+        count_failures=template.get("count-failures", 1),
+        config=MappingProxyType(dict(template.get("config", {}))),
+        tags=tuple(template.get("tags", [])),
+        inputs=inputs,
+        prerequisites=tuple(prereqs),
+        completeness_tags=tuple(template["completeness-tags"]) if "completeness-tags" in template else None,
+        session_tags=tuple(template["session-tags"]) if "session-tags" in template else None,
+        sleep_seconds=template.get("sleep_seconds", 0),
+        max_inflight=max_inflight,
+    )
+
+
+def _satisfies(step, query):
+    # True if analyses produced by `step` would match the prerequisite / find-analysis query
+    if step.gear_name != query.gear_name:
+        return False
+    if query.version_re and step.gear.gear_version and not query.version_re.search(step.gear.gear_version):
+        return False
+    if query.label and query.label not in step.label:
+        return False
+    return True
+
+
+def compile_template(template, fingerprint=None):
+    """Validates a gear template once and compiles it into an immutable RulePlan.
+
+    Gear keys are resolved, version and input regular expressions are precompiled, and
+    prerequisites and find-analysis inputs are turned into a dependency graph between steps.
+
+    Args:
+        template (dict): parsed gear template (see README)
+        fingerprint (str): optional hash or version of the template file
+
+    Raises:
+        ValueError: if the template is invalid or the step dependencies contain a cycle
+    """
+    if not isinstance(template, dict) or not isinstance(template.get("analysis"), list):
+        raise ValueError("gear template must contain an 'analysis' list")
+
+    throttle = template.get("throttle", {})
+    steps = [compile_step(t, i, throttle.get("max-inflight-gears")) for i, t in enumerate(template["analysis"])]
+
+    # dependency graph ... step i depends on every other step that can satisfy one of its prerequisites or inputs
+    edges = {}
+    for step in steps:
+        queries = [p.gear for p in step.prerequisites] + [i.find_analysis for i in step.inputs or () if i.find_analysis]
+        deps = sorted({other.index for other in steps for q in queries if other.index != step.index and _satisfies(other, q)})
+        for d in deps:
+            if d > step.index:
+                log.warning("analysis step %s depends on later step %s (%s)", step.index+1, d+1, steps[d].gear_key)
+        edges[step.index] = tuple(deps)
+
+    _check_acyclic(edges)
+
+    dependents = {d for deps in edges.values() for d in deps}
+    steps = tuple(
+        StepPlan(**{**step.__dict__, "depends_on": edges[step.index], "has_dependents": step.index in dependents})
+        for step in steps
+    )
+
+    return RulePlan(steps, MappingProxyType(dict(throttle.get("max-inflight-tags", {}))), fingerprint)
+
+
+def _check_acyclic(edges):
+    visiting, done = set(), set()
+
+    def visit(node):
+        if node in done:
+            return
+        if node in visiting:
+            raise ValueError(f"gear template has a prerequisite cycle at analysis step {node+1}")
+        visiting.add(node)
+        for dep in edges[node]:
+            visit(dep)
+        visiting.discard(node)
+        done.add(node)
+
+    for node in edges:
+        visit(node)
+
+
+def as_query(gear_info, label=None):
+    # accept either a GearQuery or a "gear-name/gear-version" string
+    return gear_info if isinstance(gear_info, GearQuery) else compile_gear_query(gear_info, label)
+
+
+def as_step(template):
+    # accept either a compiled StepPlan or a raw template step dict
+    return template if isinstance(template, StepPlan) else compile_step(template)
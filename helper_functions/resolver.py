@@ -0,0 +1,112 @@
+import logging
+import re
+import threading
+import time
+
+from helper_functions.client import fw
+
+log = logging.getLogger(__name__)
+
+# gear documents resolved with fw.lookup, keyed by "gear-name/gear-version"
+_gear_cache = {}
+# gear-info strings without a fixed version (no version or a wildcard version) -> pinned "gear-name/gear-version"
+_pinned = {}
+_lock = threading.Lock()
+
+gear_cache_stats = {"hits": 0, "misses": 0, "pinned": 0}
+
+DEFAULT_TTL = 3600
+
+# characters that mark a template gear-version as a regular expression rather than an exact version
+#   ("+" is left out: it separates semver build metadata, e.g. 1.0.0+build1, and is looked up as is)
+_WILDCARD_CHARS = set("*?[]()|^$\\")
+
+
+def split_gear_info(gear_info):
+    # Returns (gear name, gear version) from a "gear-name/gear-version" string, version is None if not passed
+    if "/" in gear_info:
+        gear_name, gear_version = gear_info.split("/", 1)
+        return gear_name, gear_version or None
+    return gear_info, None
+
+
+def is_pinned_version(gear_version):
+    return bool(gear_version) and not any(c in _WILDCARD_CHARS for c in gear_version)
+
+
+def _latest_matching_version(gear_name, gear_version):
+    # look through all installed versions of a gear and return the newest that matches the version regex
+    gears = fw.get_all_gears(all_versions=True, filter=f"gear.name={gear_name}")
+    r1 = re.compile(gear_version)
+    matches = [g for g in gears if r1.search(g.gear.version)]
+    if not matches:
+        raise ValueError(f"No installed version of gear {gear_name} matches {gear_version}")
+    return max(matches, key=lambda g: g.created).gear.version
+
+
+def pin_gear(gear_info):
+    """Returns a "gear-name/gear-version" string with an exact gear version.
+
+    Gear info without a version (latest) or with a wildcard version is resolved once and
+    then stays pinned for the rest of the run, so every session uses the same gear.
+    """
+    gear_name, gear_version = split_gear_info(gear_info)
+    if is_pinned_version(gear_version):
+        return gear_info
+
+    with _lock:
+        if gear_info in _pinned:
+            return _pinned[gear_info]
+
+    if gear_version:
+        version = _latest_matching_version(gear_name, gear_version)
+    else:
+        version = fw.lookup("gears/" + gear_name).gear.version
+
+    pinned = gear_name + "/" + version
+    with _lock:
+        _pinned.setdefault(gear_info, pinned)
+        gear_cache_stats["pinned"] += 1
+    log.info("Pinned gear %s to %s for this run", gear_info, pinned)
+
+    return _pinned[gear_info]
+
+
+def resolve_gear(gear_info, ttl=DEFAULT_TTL):
+    """Returns the flywheel gear document for a "gear-name/gear-version" string.
+
+    Lookups are memoized for `ttl` seconds, so a gear is only looked up once per run
+    rather than once per session and workflow step.
+
+    Args:
+        gear_info (str): gear name, optionally followed by "/gear-version"
+        ttl (float): seconds a cached gear document stays valid
+
+    Returns:
+        flywheel.GearDoc: gear document which can be used to submit jobs (gear.run)
+    """
+    key = pin_gear(gear_info)
+    now = time.monotonic()
+
+    with _lock:
+        cached = _gear_cache.get(key)
+        if cached and cached["expires"] > now:
+            gear_cache_stats["hits"] += 1
+            return cached["gear"]
+
+    gear = fw.lookup("gears/" + key)
+    with _lock:
+        gear_cache_stats["misses"] += 1
+        _gear_cache[key] = {"gear": gear, "expires": now + ttl}
+
+    return gear
+
+
+def invalidate_gear(gear_info=None):
+    # drop a cached gear (and its pinned version), or everything if no gear is passed
+    with _lock:
+        if gear_info is None:
+            _gear_cache.clear()
+            _pinned.clear()
+            return
+        _gear_cache.pop(_pinned.pop(gear_info, gear_info), None)
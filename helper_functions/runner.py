@@ -0,0 +1,177 @@
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('main')
+
+# per-session log buffer: records logged while a session is evaluated in a worker (thread or asyncio
+#   task) are held here and written out together once the session finishes, so output stays grouped
+#   per session. A context variable follows the session into executor threads (see run_sessions_async).
+_buffer = contextvars.ContextVar("session_log_buffer", default=None)
+_flush_lock = threading.Lock()
+
+
+class _SessionBufferFilter(logging.Filter):
+    # attached to the root handlers while the worker pool is running
+
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+
+    def filter(self, record):
+        buffer = _buffer.get()
+        if buffer is None:
+            return True
+        buffer.append((self.handler, record))
+        return False
+
+
+def _flush(records):
+    with _flush_lock:
+        for handler, record in records:
+            handler.handle(record)
+
+
+def evaluate_session(session_id, evaluate):
+    """Runs `evaluate(session_id)` with log output buffered for the session.
+
+    Exceptions are logged and swallowed so one session can not stop the others.
+
+    Returns:
+        bool: True if the session was evaluated without an exception
+    """
+    records = []
+    token = _buffer.set(records)
+    ok = True
+    try:
+        evaluate(session_id)
+    except Exception as e:
+        log.warning("Session %s: %s", session_id, e)
+        ok = False
+    finally:
+        _buffer.reset(token)
+        _flush(records)
+    return ok
+
+
+async def evaluate_session_async(session_id, evaluate, call):
+    # asyncio variant of evaluate_session, `evaluate(session_id, call)` is a coroutine function
+    records = []
+    _buffer.set(records)
+    ok = True
+    try:
+        await evaluate(session_id, call)
+    except Exception as e:
+        log.warning("Session %s: %s", session_id, e)
+        ok = False
+    finally:
+        _buffer.set(None)
+        _flush(records)
+    return ok
+
+
+class _buffered_logs:
+    # attaches the per-session buffer filter to the root handlers while sessions run concurrently
+
+    def __enter__(self):
+        self.handlers = logging.getLogger().handlers
+        self.filters = [_SessionBufferFilter(h) for h in self.handlers]
+        for h, f in zip(self.handlers, self.filters):
+            h.addFilter(f)
+
+    def __exit__(self, *exc):
+        for h, f in zip(self.handlers, self.filters):
+            h.removeFilter(f)
+
+
+def run_sessions(session_ids, evaluate, workers=1):
+    """Evaluates sessions, optionally on a bounded pool of worker threads.
+
+    Template steps of a single session always run in order in one worker, sessions
+    are evaluated concurrently. Log output is written per session rather than interleaved.
+
+    Args:
+        session_ids (iterable): flywheel session ids
+        evaluate (callable): function run for each session id (e.g. gears.run_auto_gear)
+        workers (int): number of sessions evaluated at the same time
+
+    Returns:
+        list: session ids that raised an exception
+    """
+    failed = []
+    if workers <= 1:
+        for sid in session_ids:
+            try:
+                evaluate(sid)
+            except Exception as e:
+                log.warning(e)
+                failed.append(sid)
+        return failed
+
+    with _buffered_logs():
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(evaluate_session, sid, evaluate): sid for sid in session_ids}
+            try:
+                for future, sid in futures.items():
+                    if not future.result():
+                        failed.append(sid)
+            except BaseException:
+                # interrupted (e.g. SystemExit on SIGTERM): drop queued sessions, let running ones finish
+                pool.shutdown(cancel_futures=True)
+                raise
+
+    return failed
+
+
+async def _run_pipeline(session_ids, evaluate, workers, sessions_in_flight):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(sessions_in_flight)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flywheel") as pool:
+
+        def call(fn, *args, **kwargs):
+            # run a blocking call on the bounded pool, in the calling session's context (log buffer)
+            context = contextvars.copy_context()
+            return loop.run_in_executor(pool, functools.partial(context.run, fn, *args, **kwargs))
+
+        async def one(sid):
+            async with semaphore:
+                return await evaluate_session_async(sid, evaluate, call)
+
+        try:
+            results = await asyncio.gather(*(one(sid) for sid in session_ids))
+        except BaseException:
+            # interrupted or cancelled: drop queued calls, let running ones finish
+            pool.shutdown(cancel_futures=True)
+            raise
+
+    return [sid for sid, ok in zip(session_ids, results) if not ok]
+
+
+def run_sessions_async(session_ids, evaluate, workers=8, sessions_in_flight=None):
+    """Evaluates sessions as asyncio tasks that share a bounded pool for blocking flywheel calls.
+
+    Unlike run_sessions, a session does not hold a worker for its whole evaluation: each
+    stage (e.g. loading the template, indexing analyses, resolving inputs, submitting) is a
+    separate call on the pool, so stages of different sessions overlap while each session
+    still runs its steps in order. Log output is written per session.
+
+    Args:
+        session_ids (iterable): flywheel session ids
+        evaluate (coroutine function): `await evaluate(session_id, call)`, where `call(fn, *args)`
+            runs a blocking function on the pool and returns an awaitable (e.g. gears.run_auto_gear_async)
+        workers (int): number of blocking flywheel calls running at the same time
+        sessions_in_flight (int): number of sessions being evaluated at once (default 2 x workers)
+
+    Returns:
+        list: session ids that raised an exception
+    """
+    import asyncio
+
+    session_ids = list(session_ids)
+    with _buffered_logs():
+        return asyncio.run(_run_pipeline(session_ids, evaluate, workers, sessions_in_flight or 2 * workers))
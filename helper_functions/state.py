@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+log = logging.getLogger('main')
+
+# session outcomes ... "settled" sessions need no further work until their inputs change,
+#   "open" sessions (submitted jobs, unmet prerequisites, jobs still running) are always re-evaluated
+SETTLED = "settled"
+OPEN = "open"
+
+
+class SessionStore(ABC):
+    """Base of the local per-session stores: one record per session id, kept in a file.
+
+    Loads the file at `path` if it exists and saves back to it atomically. Subclasses pick the
+    file format with `binary`, `_dump` and `_load`, and override `_content` / `_restore` to keep
+    more than the session records.
+
+    Args:
+        path (str): path to the store file, created on first save
+        save_every (int): also save after this many new records, so a run that is killed
+            (e.g. by the cron wrapper's timeout) keeps the records made so far
+    """
+    binary = False
+
+    def __init__(self, path, save_every=None):
+        self.path = path
+        self.save_every = save_every
+        self.sessions = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "rb" if self.binary else "r") as f:
+                self._restore(self._load(f))
+            log.info("Loaded %s sessions from %s", len(self.sessions), path)
+
+    @abstractmethod
+    def _dump(self, content, f):
+        """Writes `content` to the open file `f`."""
+
+    @abstractmethod
+    def _load(self, f):
+        """Returns the content read from the open file `f`."""
+
+    def _content(self):
+        return {"sessions": self.sessions}
+
+    def _restore(self, content):
+        self.sessions = content.get("sessions", {})
+
+    def _is_current(self, session_id, **fields):
+        # True if the session has a record and each of `fields` equals the recorded value
+        with self._lock:
+            record = self.sessions.get(session_id)
+        return bool(record) and all(record[key] == value for key, value in fields.items())
+
+    def _record(self, session_id, **record):
+        with self._lock:
+            self.sessions[session_id] = record
+            self._unsaved += 1
+            due = self.save_every and self._unsaved >= self.save_every
+        if due:
+            self.save()
+
+    def prune(self, session_ids):
+        # forget sessions that are not in `session_ids` any more, returns how many were dropped
+        keep = set(session_ids)
+        with self._lock:
+            before = len(self.sessions)
+            self.sessions = {sid: record for sid, record in self.sessions.items() if sid in keep}
+            return before - len(self.sessions)
+
+    def save(self):
+        # write to a temporary file first so an interrupted run never leaves a truncated file
+        with self._lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb" if self.binary else "w") as f:
+                self._dump(self._content(), f)
+            os.replace(tmp, self.path)
+            self._unsaved = 0
+
+
+class SessionStateStore(SessionStore):
+    """Local JSON record of when each session was last evaluated.
+
+    For every session the store keeps the session `modified` timestamp, the fingerprint
+    of the template it was evaluated against, and the outcome of that evaluation.
+
+    Args:
+        path (str): path to the JSON state file, created on first save
+        save_every (int): also save after this many new records, so a run that is killed
+            (e.g. by the cron wrapper's timeout) keeps the outcomes recorded so far
+    """
+
+    def _dump(self, content, f):
+        json.dump(content, f, indent=1)
+
+    def _load(self, f):
+        return json.load(f)
+
+    def is_unchanged(self, session_id, modified, template_hash):
+        # Returns True if the session was settled on the last run and nothing it depends on has moved since
+        return self._is_current(session_id, outcome=SETTLED, modified=str(modified), template_hash=template_hash)
+
+    def record(self, session_id, modified, template_hash, outcome):
+        self._record(session_id, modified=str(modified), template_hash=template_hash,
+                     outcome=outcome, evaluated=datetime.now().isoformat())
@@ -0,0 +1,56 @@
+import pickle
+
+from helper_functions.state import SessionStore
+
+
+class StatusTableStore(SessionStore):
+    """Local copy of a status table together with the session state each row was built from.
+
+    For every session the store keeps a signature of the session (its `modified` timestamp
+    and subject, see tables.session_signature), a signature of the session's analyses (ids,
+    labels, versions and job states) and the table row (None for sessions left out of the
+    table, e.g. pilots). A refresh only needs to re-fetch sessions whose timestamp, subject
+    or analyses moved. Rows are pickled so values (timestamps, booleans) come back exactly
+    as they were built.
+
+    Args:
+        path (str): path to the store file, created on first save
+    """
+    binary = True
+
+    def __init__(self, path):
+        self.meta = None
+        super().__init__(path)
+
+    def _dump(self, content, f):
+        pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, f):
+        return pickle.load(f)
+
+    def _content(self):
+        return {"meta": self.meta, "sessions": self.sessions}
+
+    def _restore(self, content):
+        self.meta, self.sessions = content["meta"], content["sessions"]
+
+    def matches(self, meta):
+        # the stored rows are only valid for the same table definition (project label, template columns)
+        return self.meta == meta
+
+    def reset(self, meta):
+        with self._lock:
+            self.meta = meta
+            self.sessions = {}
+
+    def is_unchanged(self, session_id, session, analyses):
+        return self._is_current(session_id, session=session, analyses=analyses)
+
+    def record(self, session_id, session, analyses, row):
+        self._record(session_id, session=session, analyses=analyses, row=row)
+
+    def rows(self, session_ids):
+        # stored rows in the order of `session_ids`, sessions without a row are skipped
+        with self._lock:
+            return [self.sessions[sid]["row"] for sid in session_ids
+                    if sid in self.sessions and self.sessions[sid]["row"] is not None]
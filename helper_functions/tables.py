@@ -1,16 +1,132 @@
-import sys, os, logging
-import flywheel
-from datetime import datetime, date
-import pandas as pd
+import logging
 import re
 import json
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from helper_functions.plan import compile_template
+from helper_functions.export import write_table
+from helper_functions.table_store import StatusTableStore
+from helper_functions.client import fw
 
-fw = flywheel.Client('')
 log = logging.getLogger(__name__)
 
-        
-def get_table_by_gearname(pycontext, gearname):
-    
+# session columns of the template status table (analysis columns from the template go before "Notes")
+TEMPLATE_TABLE_COLUMNS = ["timestamp", "subject.label", "session.label", "flywheel_id", "project", "Run Downstream Analyses", "Notes"]
+
+# columns of the long-form analysis records matched against template columns
+ANALYSIS_RECORD_COLUMNS = ["flywheel_id", "gear_name", "gear_version", "label", "state", "analysis_id"]
+
+# columns of the gear name status table, one row per matching analysis
+GEARNAME_TABLE_COLUMNS = ["timestamp", "subject.label", "session.label", "session.id", "project", "Run Downstream Analyses",
+                          "gear.name", "gear.version", "analysis.label", "analysis.state", "analysis.id", "cli.cmd", "Notes"]
+
+
+def iter_pages(fetch, page_size=1000, **kwargs):
+    """Pages through a flywheel list endpoint with `limit` and `after_id`.
+
+    Args:
+        fetch (callable): client method, e.g. fw.get_all_analyses
+        page_size (int): number of results per request
+        **kwargs: passed to every request (filter, inflate_job, ...)
+
+    Returns:
+        iterator: results of all pages, in server order
+    """
+    after_id = None
+    while True:
+        if after_id:
+            kwargs["after_id"] = after_id
+        page = fetch(limit=page_size, **kwargs)
+        yield from page
+        if len(page) < page_size:
+            return
+        after_id = page[-1].id
+
+
+def iter_project_analyses(project_id, gear_name, page_size=1000):
+    # all session level analyses of one gear in the project, jobs inflated so the state comes with the listing
+    query = f"parents.project={project_id},parent.type=session,gear_info.name={gear_name}"
+    return iter_pages(fw.get_all_analyses, page_size, filter=query, inflate_job=True)
+
+
+def iter_project_sessions(project_id, page_size=1000):
+    # all sessions of the project with info, tags and notes, no per-session fetch needed
+    return iter_pages(fw.get_project_sessions, page_size, project_id=project_id, include_all_info=True)
+
+
+def gearname_row(session, analysis, project_label):
+    # one gear name status table record per (session, analysis)
+    return {"timestamp": session.timestamp,
+            "subject.label": session.subject.label,
+            "session.label": session.label,
+            "session.id": str(session.id),
+            "project": project_label,
+            "Run Downstream Analyses": "COMPLETENESS" in session.info and session.info["COMPLETENESS"]["Run Downstream Analyses"] or None,
+            "gear.name": analysis.gear_info.name,
+            "gear.version": analysis.gear_info["version"],
+            "analysis.label": analysis.label,
+            "analysis.state": analysis.job.state,
+            "analysis.id": analysis.id,
+            "cli.cmd": 'fw download -o download.zip "{}/{}/{}/{}/{}"'.format(project_label, session.subject.label, session.label, "analyses", analysis.label),
+            "Notes": " ".join([x["text"] for x in session.notes])}
+
+
+def analysis_matches(analysis, gear_name, version_re=None, label=None):
+    # only flywheel jobs (not uploads) of the gear, optionally filtered by version regex and label substring
+    if not analysis.job or analysis.gear_info.name != gear_name:
+        return False
+    if version_re and not version_re.search(analysis.gear_info["version"]):
+        return False
+    if label and label not in analysis.label:
+        return False
+    return True
+
+
+def iter_gearname_rows(project, gear_name, version_re=None, label=None, bulk=True, workers=8, page_size=1000):
+    """Yields one gear name status table record per matching session analysis.
+
+    In bulk mode the project's analyses of the gear and its sessions are listed with a few
+    paged queries and joined in memory. Otherwise every session is fetched (concurrently)
+    and its analyses are matched one by one. Pilot sessions are skipped in both modes and
+    records come in session order, then analysis creation order.
+
+    Args:
+        project (flywheel.Project): project to report on
+        gear_name (str): gear name of the analyses
+        version_re (re.Pattern): optional gear version filter
+        label (str): optional analysis label substring
+        bulk (bool): list analyses project-wide instead of fetching every session
+        workers (int): sessions fetched at the same time when not in bulk mode
+        page_size (int): results per request in bulk mode
+    """
+    if not bulk:
+        session_ids = (ses.id for ses in project.sessions.iter_find())
+        for full_session in fetch_sessions(session_ids, workers):
+            if "pilot" in full_session.tags:
+                continue
+            for analysis in full_session.analyses:
+                if analysis_matches(analysis, gear_name, version_re, label):
+                    yield gearname_row(full_session, analysis, project.label)
+        return
+
+    by_session = {}
+    for analysis in iter_project_analyses(project.id, gear_name, page_size):
+        if analysis_matches(analysis, gear_name, version_re, label):
+            by_session.setdefault(analysis.parents["session"], []).append(analysis)
+    if not by_session:
+        return
+
+    for session in iter_project_sessions(project.id, page_size):
+        if session.id not in by_session or "pilot" in session.tags:
+            continue
+        for analysis in sorted(by_session[session.id], key=lambda a: a.created):
+            yield gearname_row(session, analysis, project.label)
+
+
+def get_table_by_gearname(pycontext, gearname, bulk=True, workers=8):
+    import pandas as pd
+
     pycontext["gear"] = gearname
     log.info("Using Configuration Settings: ")
     log.parent.handlers[0].setFormatter(logging.Formatter('\t%(message)s'))
@@ -22,8 +138,6 @@ def get_table_by_gearname(pycontext, gearname):
     if "regex" in pycontext:
         log.info("analysis label regex: %s", str(pycontext["regex"]))
     log.parent.handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-    
-    summary=pd.DataFrame()
 
     # find flywheel project
     project = fw.projects.find_one('label='+pycontext["project"]+',group='+pycontext["group"])
@@ -31,68 +145,153 @@ def get_table_by_gearname(pycontext, gearname):
     # get full flywheel object
     project = fw.get_project(project.id)
     
-    # get gear-name
-    gear = pycontext["gear"]
+    version_re = re.compile(pycontext["version"]) if "version" in pycontext else None
+
+    # collect plain records (project label resolved once) and build the table in one go
+    records = list(iter_gearname_rows(project, gearname, version_re, pycontext.get("regex"), bulk=bulk, workers=workers))
+    summary = pd.DataFrame(records, columns=GEARNAME_TABLE_COLUMNS)
+
+    summary = summary.sort_values('timestamp', ignore_index = True)
     
-    # loop session in project
-    for ses in project.sessions.find():
+    return summary
+
+        
+def fetch_sessions(session_ids, workers=8):
+    """Fetches full flywheel sessions concurrently.
+
+    Args:
+        session_ids (iterable): flywheel session ids
+        workers (int): number of sessions fetched at the same time
+
+    Returns:
+        iterator: full session objects, in the same order as `session_ids`
+    """
+    # at most 2 x workers sessions are requested ahead of the consumer, so memory stays bounded
+    #   for slow consumers (e.g. streaming exports) and `session_ids` can be a lazy iterator
+    session_ids = iter(session_ids)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque(pool.submit(fw.get_session, sid) for sid in itertools.islice(session_ids, 2 * workers))
+        while pending:
+            full_session = pending.popleft().result()
+            for sid in itertools.islice(session_ids, 1):
+                pending.append(pool.submit(fw.get_session, sid))
+            yield full_session
+
+
+def template_columns(plan):
+    # matching rules for each status table column: (column label, gear name, compiled gear version regex or None),
+    # one column per gear-name/gear-version of the template (a later step's label wins, as in plan.table_columns)
+    columns = {}
+    for step in plan.steps:
+        columns[step.gear_key] = (step.label, step.gear_name, step.gear.version_re)
+    return list(columns.values())
+
+
+def version_matches(version_re, version):
+    # same rule as my_analysis_exists (SessionAnalysisIndex.find): the version regex is searched in the gear version
+    return version_re is None or bool(version_re.search(version or ""))
+
+
+def session_record(full_session, project_label):
+    # session part of a template status table record (everything but the analysis columns)
+    return {"timestamp": full_session.timestamp,
+            "subject.label": full_session.subject.label,
+            "session.label": full_session.label,
+            "flywheel_id": str(full_session.id),
+            "project": project_label,
+            "Run Downstream Analyses": full_session.info["COMPLETENESS"]["Run Downstream Analyses"] if "COMPLETENESS" in full_session.info else None,
+            "Notes": " ".join([x["text"] for x in full_session.notes])}
+
 
-        full_session=fw.get_session(ses.id)
+def analysis_records(full_session):
+    # long-form records of the session's job analyses (uploads have no job), in session order
+    return [{"flywheel_id": str(full_session.id),
+             "gear_name": analysis.gear_info.name,
+             "gear_version": analysis.gear_info.version,
+             "label": analysis.label,
+             "state": analysis.job.state,
+             "analysis_id": str(analysis.id)}
+            for analysis in full_session.analyses if analysis.job]
 
-        if  "pilot" in full_session.tags:
+
+def template_row(full_session, project_label, columns):
+    # one status table record per session: session info, the last complete analysis id per template column, notes
+    row = session_record(full_session, project_label)
+    notes = row.pop("Notes")
+    for label, _, _ in columns:
+        row[label] = ""
+
+    for analysis in full_session.analyses:
+        if not analysis.job or analysis.job.state != "complete":
             continue
-        
-        # loop analyses in session TODO: Find a more generic walker strategy
-        for analysis in full_session.analyses:
-            
-            # only explore flywheel jobs (not uploads)
-            if not analysis.job:
+        for label, gear_name, version_re in columns:
+            if analysis.gear_info.name != gear_name or label not in analysis.label:
                 continue
-
-        for analysis in full_session.analyses:
-            if not analysis.job:
+            if not version_matches(version_re, analysis.gear_info.version):
                 continue
-            
-            #only print ones that match the analysis label
-            if pycontext["gear"] == analysis.gear_info.name:
-                if "version" in pycontext:
-                    r1 = re.compile(pycontext["version"])
-                    if not r1.search(analysis.gear_info["version"]):
-                        continue
-                if "regex" in pycontext and pycontext["regex"] not in analysis.label:
-                    continue
-                
-                # we met all conditions, store in table now
-                df=pd.DataFrame({"timestamp":full_session.timestamp, 
-                                 "subject.label":full_session.subject.label, 
-                                 "session.label":full_session.label,
-                                 "session.id": str(full_session.id),
-                                 "project": fw.get_container(full_session.project).label,
-                                 "Run Downstream Analyses": "COMPLETENESS" in full_session.info and full_session.info["COMPLETENESS"]["Run Downstream Analyses"] or None,
-                                 "gear.name": analysis.gear_info.name,
-                                 "gear.version": analysis.gear_info["version"],
-                                 "analysis.label": analysis.label,
-                                 "analysis.state": analysis.job.state,
-                                 "analysis.id": analysis.id,
-                                 "cli.cmd": 'fw download -o download.zip "{}/{}/{}/{}/{}"'.format(fw.get_container(full_session.project).label,full_session.subject.label, full_session.label,"analyses",analysis.label),
-                                 "Notes": " ".join([x["text"] for x in full_session.notes])}, index=[0])
-            
-
-
-                summary = pd.concat([summary, df])
+            row[label] = str(analysis.id)
 
-    summary = summary.sort_values('timestamp', ignore_index = True)
-    
-    return summary
+    row["Notes"] = notes
+    return row
 
-        
-def get_table_by_template(user_inputs):
-    
-    log.info("Using Configuration Settings: ")
-    log.parent.handlers[0].setFormatter(logging.Formatter('\t%(message)s'))
-    log.info("project: %s", str(user_inputs["project"]))
 
-    # get project specifics
+def iter_template_sessions(project, workers=8):
+    # full (non pilot) sessions of the project, each session is fetched exactly once
+    session_ids = (ses.id for ses in project.sessions.iter_find())
+    for full_session in fetch_sessions(session_ids, workers):
+        if "pilot" in full_session.tags:
+            continue
+        yield full_session
+
+
+def iter_template_rows(project, plan, workers=8):
+    # yields one record per (non pilot) session of the project
+    columns = template_columns(plan)
+    for full_session in iter_template_sessions(project, workers):
+        yield template_row(full_session, project.label, columns)
+
+
+def match_template_columns(analyses, columns):
+    """Matches long-form analyses to template status table columns.
+
+    Same rules as template_row, applied to all sessions at once: an analysis fills a column
+    if its job is complete, the gear name matches, the column label is part of the analysis
+    label and, if the column has a version, the version regex is found in the gear version. When several
+    analyses of a session match a column, the last one (in session order) wins.
+
+    Args:
+        analyses (pandas.DataFrame): analysis_records of all sessions (flywheel_id, gear_name,
+            gear_version, label, state, analysis_id), in session order
+        columns (list): (column label, gear name, gear version regex or None) from template_columns
+
+    Returns:
+        pandas.DataFrame: analysis id per column label (columns), indexed by flywheel_id
+    """
+    import pandas as pd
+
+    rules = pd.DataFrame(columns, columns=["column", "gear_name", "version_re"])
+    analyses = analyses[analyses["state"] == "complete"].reset_index(drop=True)
+    analyses["order"] = analyses.index
+
+    # candidate (analysis, column) pairs by gear name, then version and label rules
+    matches = analyses.merge(rules, on="gear_name")
+    version_ok = pd.Series([version_matches(r, version) for r, version in zip(matches["version_re"], matches["gear_version"])], index=matches.index, dtype=bool)
+    label_ok = pd.Series([column in label for column, label in zip(matches["column"], matches["label"])], index=matches.index, dtype=bool)
+    matches = matches[version_ok & label_ok]
+
+    # last match per session and column wins
+    matches = matches.sort_values("order", kind="stable").drop_duplicates(["flywheel_id", "column"], keep="last")
+    return matches.pivot(index="flywheel_id", columns="column", values="analysis_id")
+
+
+def template_table_columns(columns):
+    # session columns, one column per template analysis label (first occurrence wins), then notes
+    analysis_columns = list(dict.fromkeys(label for label, _, _ in columns))
+    return TEMPLATE_TABLE_COLUMNS[:-1] + analysis_columns + ["Notes"]
+
+
+def load_template_plan(user_inputs):
+    # find the project and compile its gear template, plan is None if the template is not valid JSON
     project = fw.projects.find_one(f'label={user_inputs["project"]},group={user_inputs["group"]}')
     template_file = project.get_file("gears_template_JSON.txt")
     
@@ -104,65 +303,160 @@ def get_table_by_template(user_inputs):
         template = json.loads(file_content.decode('utf-8'))  # Decode bytes to string and load JSON
     except json.JSONDecodeError as e:
         print(f"Failed to parse JSON: {e}")
-        return
+        return project, None
 
-    # STEP 1: create dataframe with all sessions and info
-    table = pd.DataFrame()
-    for ses in project.sessions.find():
+    # columns to pull come from the compiled template plan, one column per gear-name/gear-version
+    return project, compile_template(template)
 
-        full_session=fw.get_session(ses.id)
 
-        if  "pilot" in full_session.tags:
-            continue
+def get_table_by_template(user_inputs, workers=8):
+    import pandas as pd
 
-        df=pd.DataFrame({"timestamp": full_session.timestamp,
-                         "subject.label":full_session.subject.label, 
-                         "session.label":full_session.label,
-                         "flywheel_id": str(full_session.id),
-                         "project": fw.get_container(full_session.project).label,
-                         "Run Downstream Analyses": full_session.info["COMPLETENESS"]["Run Downstream Analyses"] if "COMPLETENESS" in full_session.info else None,
-                         "Notes": " ".join([x["text"] for x in full_session.notes])}, index=[0])
-        table = pd.concat([table,df], ignore_index = True)
-    
-    log.info('adding %s sessions...', len(table))
-    
-    # STEP 2: Sort Columns to Pull
-    gears_dict = {}
-    for itr, itr_template in enumerate(template["analysis"]):
+    log.info("Using Configuration Settings: ")
+    log.parent.handlers[0].setFormatter(logging.Formatter('\t%(message)s'))
+    log.info("project: %s", str(user_inputs["project"]))
 
-        # analysis information...
-        my_gear_name=itr_template["gear-name"]+"/"+itr_template["gear-version"] if "gear-version" in itr_template else itr_template["gear-name"]
-        my_gear_label = itr_template["custom-label"] if "custom-label" in itr_template else itr_template["gear-name"]
+    # get project specifics
+    project, plan = load_template_plan(user_inputs)
+    if plan is None:
+        return
 
-        gears_dict.update({my_gear_name: my_gear_label})
-    
-    log.info('adding %s analyses from template...', len(gears_dict))
-    
-    #initalize columns
-    for gear in gears_dict.keys():
-        table[gears_dict[gear]] = ""
-    
-    # STEP 3: fill in analysis columns
-    for idx, row in table.iterrows():
-        full_session = fw.get_session(row["flywheel_id"])
-
-        for analysis in full_session.analyses:
-                if not analysis.job:
-                    continue
-                if analysis.job.state == "complete":
-                    for g in gears_dict.keys():
-                        if "/" in g:   ## this is a gear + version
-                            if (analysis.gear_info.name == g.split("/")[0]) and (analysis.gear_info.version == g.split("/")[1]) and (gears_dict[g] in analysis.label):
-                                table.loc[idx, gears_dict[g]] = str(analysis.id)
-                        else:
-                            if (analysis.gear_info.name == g) and (gears_dict[g] in analysis.label):
-                                table.loc[idx, gears_dict[g]] = str(analysis.id)
-    
-    # make sure notes are last column
-    column_to_move = table.pop("Notes")
-    table.insert(len(table.columns), "Notes", column_to_move)
+    columns = template_columns(plan)
+    log.info('adding %s analyses from template...', len(columns))
+
+    # fetch every session once (concurrently), collecting plain session records and long-form analyses
+    sessions, analyses = [], []
+    for full_session in iter_template_sessions(project, workers):
+        sessions.append(session_record(full_session, project.label))
+        analyses.extend(analysis_records(full_session))
+    log.info('adding %s sessions...', len(sessions))
+
+    # match analyses to template columns with one join and pivot, then attach them to the sessions
+    matched = match_template_columns(pd.DataFrame(analyses, columns=ANALYSIS_RECORD_COLUMNS), columns)
+    table = pd.DataFrame(sessions, columns=TEMPLATE_TABLE_COLUMNS).join(matched, on="flywheel_id")
+    table = table.reindex(columns=template_table_columns(columns))
+    analysis_columns = table.columns[len(TEMPLATE_TABLE_COLUMNS)-1:-1]
+    table[analysis_columns] = table[analysis_columns].fillna("")
     
     table = table.sort_values('timestamp', ignore_index = True)
     
     return table
 
+
+def analysis_signatures(project_id, gear_names, page_size=1000):
+    # per session, the (id, label, version, job state) of its analyses of the given gears, from bulk listings
+    signatures = {}
+    for gear_name in sorted(gear_names):
+        for analysis in iter_project_analyses(project_id, gear_name, page_size):
+            state = analysis.job.state if analysis.job else None
+            signatures.setdefault(analysis.parents["session"], set()).add((analysis.id, analysis.label, analysis.gear_info["version"], state))
+    return {sid: frozenset(signature) for sid, signature in signatures.items()}
+
+
+def session_signature(session):
+    # what a template row depends on besides the analyses: renaming a subject does not touch the session's `modified`
+    return (session.modified, session.subject.id, session.subject.label)
+
+
+def refresh_table_by_template(user_inputs, path, workers=8):
+    """Returns the template status table, rebuilt incrementally from a local store.
+
+    The table rows are kept in `path` with each session's `modified` timestamp, its subject
+    (id and label) and a signature of its template analyses. On refresh, sessions and
+    analyses are listed with a few paged queries and only sessions that were added, or whose
+    timestamp, subject or analyses changed, are fetched again. Deleted sessions are dropped. A changed template or project
+    label rebuilds everything. The result is the same table get_table_by_template returns.
+
+    Args:
+        user_inputs (dict): "project" and "group" labels
+        path (str): local store file, created on the first call
+        workers (int): number of changed sessions fetched at the same time
+
+    Returns:
+        pandas.DataFrame: the status table (None if the template could not be read)
+    """
+    import pandas as pd
+
+    log.info("refreshing template table of %s from %s", user_inputs["project"], path)
+    project, plan = load_template_plan(user_inputs)
+    if plan is None:
+        return
+
+    columns = template_columns(plan)
+    store = StatusTableStore(path)
+    # stored rows are only reused for the same project and column rules (version patterns as text)
+    meta = {"project": project.label, "columns": [(label, gear_name, r.pattern if r else None) for label, gear_name, r in columns],
+            "versions": "regex", "signature": "subject"}
+    if not store.matches(meta):
+        log.info("no stored table for this project and template, building all sessions")
+        store.reset(meta)
+
+    # list first, fetch second: a change landing in between is picked up by the next refresh
+    sessions = {ses.id: session_signature(ses) for ses in iter_project_sessions(project.id)}
+    signatures = analysis_signatures(project.id, {gear_name for _, gear_name, _ in columns})
+
+    removed = store.prune(sessions)
+    changed = [sid for sid, session in sessions.items() if not store.is_unchanged(sid, session, signatures.get(sid, frozenset()))]
+    for full_session in fetch_sessions(changed, workers):
+        row = None if "pilot" in full_session.tags else template_row(full_session, project.label, columns)
+        store.record(full_session.id, sessions[full_session.id], signatures.get(full_session.id, frozenset()), row)
+    store.save()
+    log.info("refreshed %s sessions, removed %s, %s unchanged", len(changed), removed, len(sessions) - len(changed))
+
+    table = pd.DataFrame(store.rows(sessions), columns=template_table_columns(columns))
+
+    table = table.sort_values('timestamp', ignore_index = True)
+
+    return table
+
+
+def export_table_by_template(user_inputs, path, fmt=None, chunk_rows=10000, workers=8):
+    """Streams the template status table of a project to a CSV or Parquet file.
+
+    Same rows and columns as get_table_by_template, but rows are written as sessions are
+    processed and ordered by timestamp with an external sort, so memory stays flat for
+    projects of any size.
+
+    Args:
+        user_inputs (dict): "project" and "group" labels
+        path (str): output .csv or .parquet file
+        fmt (str): "csv" or "parquet", taken from the extension of `path` by default
+        chunk_rows (int): rows held in memory at once
+        workers (int): number of sessions fetched at the same time
+
+    Returns:
+        int: number of rows written (None if the template could not be read)
+    """
+    log.info("exporting template table of %s to %s", user_inputs["project"], path)
+    project, plan = load_template_plan(user_inputs)
+    if plan is None:
+        return
+
+    columns = template_table_columns(template_columns(plan))
+    return write_table(iter_template_rows(project, plan, workers), path, columns, fmt, chunk_rows=chunk_rows)
+
+
+def export_table_by_gearname(pycontext, gearname, path, fmt=None, chunk_rows=10000, workers=8):
+    """Streams the gear name status table of a project to a CSV or Parquet file.
+
+    Same rows and columns as get_table_by_gearname. Sessions are walked one at a time
+    (fetched concurrently) instead of in bulk mode, which would hold every matching
+    analysis of the project in memory.
+
+    Args:
+        pycontext (dict): "project" and "group" labels, optional "version" regex and "regex" label substring
+        gearname (str): gear name of the analyses
+        path (str): output .csv or .parquet file
+        fmt (str): "csv" or "parquet", taken from the extension of `path` by default
+        chunk_rows (int): rows held in memory at once
+        workers (int): number of sessions fetched at the same time
+
+    Returns:
+        int: number of rows written
+    """
+    log.info("exporting %s table of %s to %s", gearname, pycontext["project"], path)
+    project = fw.projects.find_one('label='+pycontext["project"]+',group='+pycontext["group"])
+    version_re = re.compile(pycontext["version"]) if "version" in pycontext else None
+
+    rows = iter_gearname_rows(project, gearname, version_re, pycontext.get("regex"), bulk=False, workers=workers)
+    return write_table(rows, path, GEARNAME_TABLE_COLUMNS, fmt, chunk_rows=chunk_rows)
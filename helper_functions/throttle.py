@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+from helper_functions.client import fw
+
+log = logging.getLogger('main')
+
+INFLIGHT_STATES = ["pending", "running"]
+
+
+class SubmissionThrottle:
+    """Holds back job submissions while the flywheel job queue is saturated.
+
+    The number of pending and running jobs per gear name or job tag is read from
+    flywheel (and cached for `refresh_seconds`). A submission only waits when one
+    of its limits is reached, and gives up after `max_wait_seconds`.
+
+    Args:
+        poll_seconds (float): seconds between queue checks while waiting
+        max_wait_seconds (float): longest time a single submission waits for a free slot
+        refresh_seconds (float): seconds the in-flight job counts are reused before re-querying flywheel
+    """
+
+    def __init__(self, poll_seconds=30, max_wait_seconds=1800, refresh_seconds=15):
+        self.poll_seconds = poll_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.refresh_seconds = refresh_seconds
+        self.stats = {"waits": 0, "seconds": 0.0, "gave_up": 0}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inflight(self, field, value, refresh=False):
+        # number of pending + running jobs where job field (e.g. "gear_info.name" or "tags") matches value
+        key = (field, value)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached and not refresh and now - cached["time"] < self.refresh_seconds:
+                return cached["count"]
+
+        count = sum(len(fw.jobs.find(f"state={state},{field}={value}")) for state in INFLIGHT_STATES)
+        with self._lock:
+            self._counts[key] = {"count": count, "time": now}
+        return count
+
+    def saturated(self, gear_name, tags, gear_limit=None, tag_limits=None, refresh=False):
+        # Returns a description of the first limit that is reached, else None
+        if gear_limit is not None and self.inflight("gear_info.name", gear_name, refresh) >= gear_limit:
+            return f"gear {gear_name} (limit {gear_limit})"
+        for tag in tags or []:
+            limit = (tag_limits or {}).get(tag)
+            if limit is not None and self.inflight("tags", tag, refresh) >= limit:
+                return f"tag {tag} (limit {limit})"
+        return None
+
+    def wait(self, gear_name, tags, gear_limit=None, tag_limits=None):
+        """Blocks until a job for this gear and tags can be submitted.
+
+        Returns:
+            bool: True if a slot is free, False if the queue stayed saturated for `max_wait_seconds`
+        """
+        if gear_limit is None and not tag_limits:
+            return True
+
+        start = time.monotonic()
+        reason = self.saturated(gear_name, tags, gear_limit, tag_limits)
+        if not reason:
+            return True
+
+        log.info("Job queue saturated for %s... waiting", reason)
+        with self._lock:
+            self.stats["waits"] += 1
+        while reason:
+            if time.monotonic() - start >= self.max_wait_seconds:
+                break
+            time.sleep(self.poll_seconds)
+            reason = self.saturated(gear_name, tags, gear_limit, tag_limits, refresh=True)
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats["seconds"] += waited
+            if reason:
+                self.stats["gave_up"] += 1
+        if reason:
+            log.warning("Job queue still saturated for %s after %.0f seconds", reason, waited)
+            return False
+        return True
+
+    def record_submission(self, gear_name, tags):
+        # count a new submission against the cached totals until the next refresh from flywheel
+        with self._lock:
+            keys = [("gear_info.name", gear_name)] + [("tags", tag) for tag in tags or []]
+            for key in keys:
+                if key in self._counts:
+                    self._counts[key]["count"] += 1
+
+
+# throttle shared by every session evaluated in this run
+throttle = SubmissionThrottle()
@@ -1,18 +1,9 @@
-from pathlib import Path
 import subprocess as sp
-import sys, os, logging
-import flywheel
-from datetime import datetime, date
-import glob
-import pandas as pd
-from time import sleep
-import time
-import re
-import tempfile
-from zipfile import ZipFile
-import json
-
-fw = flywheel.Client('')
+import logging
+from datetime import datetime
+from helper_functions.resolver import resolve_gear
+from helper_functions.job_monitor import monitor
+
 log = logging.getLogger(__name__)
 
 
@@ -20,7 +11,7 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
     """Submits a job with specified gear and inputs.
     
     Args:
-        gear (flywheel.Gear): A Flywheel Gear.
+        gear (flywheel.Gear or str): A Flywheel Gear, or "gear-name/gear-version" to resolve through the gear cache.
         config (dict): Configuration dictionary for the gear.
         inputs (dict): Input dictionary for the gear.
         tags (list): List of tags for gear
@@ -31,6 +22,12 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         str: The id of the submitted job (for utility gear) or analysis container (for analysis gear).
         
     """
+    if isinstance(gear, str):
+        gear = resolve_gear(gear)
+
+    # the sdk is already loaded by the client that fetched the gear
+    from flywheel.rest import ApiException
+
     try:
         # Run the gear on the inputs provided, stored output in dest constainer and returns job ID
         if not analysis_label:
@@ -41,31 +38,34 @@ def run_gear(gear, config, inputs, tags, dest, analysis_label=[]):
         log.debug('Submitted job %s', gear_job_id)
         
         return gear_job_id
-    except flywheel.rest.ApiException:
+    except ApiException:
         log.exception('An exception was raised when attempting to submit a job for %s',
-                      gear_job_id.name)
+                      gear['gear']['name'])
 
 
 
-def holdjob(jobids, timeout, period=0.25):
-    mustend = time.time() + timeout
-    while time.time() < mustend:
-        if isinstance(jobids, str):
-            jobid =  [jobids]
-        
-        for jid in jobids:
-            anlys = fw.get_job(jid)
-            
-            if any(anlys.state.lower() == s for s in ['complete','cancelled','failed']): 
-                log.info('Job %s: completed with status: %s', anlys.id, anlys.state) 
-                jobids.remove(jid)
-        
-        if isempty(jobids):
-            return True
-    
-        time.sleep(period)
-        log.info('Job %s: timeout after %s seconds... continuing run script', jobid.id, timeout)
-        
+def holdjob(jobids, timeout, period=None):
+    """Blocks until the given jobs finished (complete, cancelled or failed) or `timeout` seconds passed.
+
+    Jobs are watched by the shared job monitor, which checks all watched jobs with one bulk
+    query per tick and backs off as they age. Jobs still running at the timeout are no
+    longer checked.
+
+    Args:
+        jobids (str or list): flywheel job id(s)
+        timeout (float): seconds to wait
+        period (float): shortest time between checks of these jobs, defaults to the monitor's setting
+
+    Returns:
+        bool: True if all jobs finished in time
+    """
+    if isinstance(jobids, str):
+        jobids = [jobids]
+
+    if monitor.wait(list(jobids), timeout, poll_seconds=period):
+        return True
+
+    log.info('Jobs %s: timeout after %s seconds... continuing run script', ", ".join(jobids), timeout)
     return False
 
 
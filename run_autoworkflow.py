@@ -1,6 +1,11 @@
 import os
-import flywheel
-from helper_functions import gears
+import sys
+import signal
+import argparse
+import threading
+from helper_functions import client, gears, resolver, runner, throttle
+from helper_functions.state import SessionStateStore
+from helper_functions.context import SessionContext
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger('main')
@@ -8,25 +13,119 @@ log = logging.getLogger('main')
 # set default permissions
 os.umask(0o002);
 
-# get flywheel client
-fw = flywheel.Client('')
+# shared flywheel client, created on the first API call
+fw = client.fw
+
+
+TEMPLATE_FILE_NAME = "gears_template_JSON.txt"
+
+# template fingerprint per project, looked up once per run
+_template_hashes = {}
+_template_lock = threading.Lock()
+
+
+def get_template_hash(project_id):
+    with _template_lock:
+        if project_id in _template_hashes:
+            return _template_hashes[project_id]
+    template_file = fw.get_project(project_id).get_file(TEMPLATE_FILE_NAME)
+    template_hash = gears.file_fingerprint(template_file) if template_file else None
+    with _template_lock:
+        _template_hashes[project_id] = template_hash
+    return template_hash
+
+
+def is_unchanged(session, state, full_rescan):
+    # sessions settled on a previous run are skipped if neither the session nor the template has changed
+    if state is None or full_rescan:
+        return False
+    if state.is_unchanged(session.id, session.modified, get_template_hash(session.parents["project"])):
+        log.debug("unchanged since last run: %s", session.id)
+        return True
+    return False
+
+
+def record_outcome(session, state, outcome):
+    if state is not None and outcome:
+        state.record(session.id, session.modified, get_template_hash(session.parents["project"]), outcome)
+
+
+def check_workflow(session, state=None, full_rescan=False, collect=None):
+    if is_unchanged(session, state, full_rescan):
+        return
+
+    ctx = SessionContext(session.id)
+    log.info("checking workflow: %s", ctx.describe())
+
+    outcome = gears.run_auto_gear(ctx, template_file_name=TEMPLATE_FILE_NAME, collect=collect)
+
+    record_outcome(session, state, outcome)
+
+
+async def check_workflow_async(session, call, state=None, full_rescan=False, collect=None):
+    # same as check_workflow, with blocking flywheel calls run through `call` (see runner.run_sessions_async)
+    if await call(is_unchanged, session, state, full_rescan):
+        return
+
+    ctx = SessionContext(session.id)
+    log.info("checking workflow: %s", await call(ctx.describe))
+
+    outcome = await gears.run_auto_gear_async(ctx, call, template_file_name=TEMPLATE_FILE_NAME, collect=collect)
+
+    await call(record_outcome, session, state, outcome)
 
 
 if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Apply project gear templates to recently created sessions")
+    parser.add_argument("--lookback", type=int, default=7, help="number of days to look back for new sessions (default: 7)")
+    parser.add_argument("--workers", type=int, default=1, help="number of sessions evaluated concurrently (default: 1)")
+    parser.add_argument("--pipeline", action="store_true", help="evaluate sessions with the asyncio pipeline, overlapping the flywheel calls of different sessions on --workers threads")
+    parser.add_argument("--state-file", default="auto_run_gears_state.json", help="file recording the outcome of each session between runs, pass an empty string to disable")
+    parser.add_argument("--full-rescan", action="store_true", help="re-evaluate every session in the lookback window, even if unchanged since the last run")
+    parser.add_argument("--batch", action="store_true", help="collect all approved analyses first, then submit them as flywheel batch jobs")
+    parser.add_argument("--batch-size", type=int, default=100, help="number of jobs per batch proposal (default: 100)")
+    parser.add_argument("--max-queue-wait", type=float, default=1800, help="longest time (seconds) a submission waits for a saturated job queue (default: 1800)")
+    args = parser.parse_args()
+
+    throttle.throttle.max_wait_seconds = args.max_queue_wait
+    # one pooled connection per worker thread, plus a few for the job monitor and throttle queries
+    client.configure(pool_size=args.workers + 4)
     
     # locate sessions generated within lookback window
-    lookback = 7
-    created_by = gears.get_x_days_ago(lookback).strftime('%Y-%m-%d')
+    created_by = gears.get_x_days_ago(args.lookback).strftime('%Y-%m-%d')
     filtered_sessions=fw.sessions.find(f'created>{created_by}')
 
+    # save the state every 50 sessions, and turn the wrapper's timeout (SIGTERM) into SystemExit
+    # so the final save in the finally block below still runs
+    state = SessionStateStore(args.state_file, save_every=50) if args.state_file else None
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    sessions = {session.id: session for session in filtered_sessions}
+    collected = [] if args.batch else None
+
     #Loop through sessions and see which ones apply for the gear rule to kick off
-    for session in filtered_sessions:
-        sid = session.id
+    try:
+        if args.pipeline:
+            failed = runner.run_sessions_async(list(sessions), lambda sid, call: check_workflow_async(sessions[sid], call, state, args.full_rescan, collected), workers=args.workers)
+        else:
+            failed = runner.run_sessions(list(sessions), lambda sid: check_workflow(sessions[sid], state, args.full_rescan, collected), workers=args.workers)
+    finally:
+        if state is not None:
+            state.prune(sessions)
+            state.save()
+    if failed:
+        log.warning("%s sessions raised errors: %s", len(failed), " ".join(failed))
 
-        log.info("checking workflow: %s/%s/%s",fw.get_project(fw.get_session(sid).parents["project"]).label, fw.get_session(sid).subject.label, fw.get_session(sid).label)
+    if collected:
+        # the batch job models are only loaded for --batch runs
+        from helper_functions import batch
+        submitted = batch.submit_batch(collected, chunk_size=args.batch_size)
+        log.info("batch submission: %s jobs submitted in %s batches, %s failed", len(submitted["submitted"]), len(submitted["batches"]), len(submitted["failed"]))
+        for item in submitted["failed"]:
+            log.warning("FAILED batch job: %s for Session %s: %s", item["label"], item["session"], item["error"])
 
-        try:
-            gears.run_auto_gear(sid)
-        except Exception as e:
-            log.warning(e)
+    log.info("template cache: %s hits, %s misses", gears.template_cache_stats["hits"], gears.template_cache_stats["misses"])
+    log.info("input cache: %s hits, %s misses", gears.input_cache_stats["hits"], gears.input_cache_stats["misses"])
+    log.info("gear cache: %s hits, %s misses, %s pinned", resolver.gear_cache_stats["hits"], resolver.gear_cache_stats["misses"], resolver.gear_cache_stats["pinned"])
+    log.info("throttled: %s waits, %.0f seconds, %s gave up", throttle.throttle.stats["waits"], throttle.throttle.stats["seconds"], throttle.throttle.stats["gave_up"])
     
\ No newline at end of file
@@ -16,6 +16,7 @@ source /curc/sw/anaconda3/latest
 conda activate flywheel
 
 # Launch auto-gear set (uses gear template stored in flywhel project)
+# Pass "--workers N" to evaluate N sessions at the same time.
 # Using "timeout" prevents the script hanging when launched automatically.
 # This time limit may need to be adjusted based on the speed of your system.
 timeout 300m python run_autoworkflow.py "$@" 2>&1 | tee -a "$logfile"